@@ -0,0 +1,199 @@
+"""Runs the research graph over a JSONL file of product links.
+
+    python batch.py urls.jsonl -o results.jsonl -c 8
+
+Every input line is a JSON object with the link in "url" (or "product_link"/"link"), any other
+string field holding a link works too. One result record is appended to the output file as soon
+as a run finishes, and links that already have an "ok" record there are skipped, so a crashed
+job is resumed by running the same command again.
+
+With --refresh the stored reports are brought up to date instead (see service.refresh_product),
+the records then carry a "changes" summary and the name of the refresh run (--run, by default
+today's UTC date). Only records of the same run count as done, so a crashed refresh is resumed
+by running the same command again but an earlier refresh or research does not skip anything.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from graph import app
+from nodes import close_async_tavily
+from service import aresearch_product, arefresh_product
+from url_canonical import canonicalize_url
+from ratelimit import priority
+
+URL_PATTERN = re.compile(r"https?://\S+")
+
+
+def read_inputs(path: str) -> List[Dict[str, Any]]:
+    """Reads the input JSONL and returns {"id", "url"} records (lines without a link are reported and skipped)."""
+    inputs = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"line {line_no}: not valid JSON, skipped", file=sys.stderr)
+                continue
+            if not isinstance(record, dict):
+                print(f"line {line_no}: not a JSON object, skipped", file=sys.stderr)
+                continue
+            url = record.get("url") or record.get("product_link") or record.get("link")
+            if not url:
+                for value in record.values():
+                    found = URL_PATTERN.search(value) if isinstance(value, str) else None
+                    if found:
+                        url = found.group(0).rstrip(").,\"'")
+                        break
+            if not url:
+                print(f"line {line_no}: no product link, skipped", file=sys.stderr)
+                continue
+            inputs.append({"id": record.get("id") or record.get("request_id") or str(line_no), "url": url})
+    return inputs
+
+
+def read_done(path: str, run: Optional[str] = None) -> Set[str]:
+    """Returns the canonical keys that already have a successful record (of this refresh run) in the output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be cut off if the job crashed while writing it
+                continue
+            if record.get("status") == "ok" and record.get("run") == run:
+                done.add(record["key"])
+    return done
+
+
+class BatchRunner:
+    """Runs the links with bounded concurrency and appends one record per finished run."""
+
+    def __init__(self, output: str, concurrency: int = 4, use_cache: bool = True, refresh: bool = False, run: Optional[str] = None):
+        self.output = output
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.refresh = refresh
+        self.run_name = run
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self._lock = asyncio.Lock()
+
+    async def run(self, inputs: List[Dict[str, Any]]) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.total = len(inputs)
+        self.started_at = time.time()
+        with open(self.output, "a") as out:
+            async def worker(item):
+                async with semaphore:
+                    record = await self.research(item)
+                await self.write(out, record)
+
+            await asyncio.gather(*(worker(item) for item in inputs))
+        await close_async_tavily()
+        self.report_progress(final=True)
+
+    async def research(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        key = canonicalize_url(item["url"]).key
+        # every run gets its own thread, it is deleted afterwards since nobody will chat with it
+        config = {"configurable": {"thread_id": f"batch-{uuid.uuid4().hex}"}}
+        started = time.time()
+        try:
+            # batch calls wait behind chat turns and interactive research for the provider budget
+            with priority("background"):
+                if self.refresh:
+                    result = await arefresh_product(item["url"], config)
+                else:
+                    result = await aresearch_product(item["url"], config, use_cache=self.use_cache)
+            status = "ok" if result.get("final_report") else "error"
+            record = {
+                "product_query": result.get("product_query"),
+                "final_report": result.get("final_report"),
+                "reviews_analysis": result.get("reviews_analysis"),
+                "cached": result.get("cached", False),
+                "changes": result.get("changes"),
+                "error": None if status == "ok" else "no report generated",
+            }
+        except Exception as e:
+            status = "error"
+            record = {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            await app.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+        if self.run_name:
+            record["run"] = self.run_name
+        return dict(
+            {"id": item["id"], "url": item["url"], "key": key, "status": status, "elapsed": round(time.time() - started, 2)},
+            **record,
+        )
+
+    async def write(self, out, record: Dict[str, Any]) -> None:
+        async with self._lock:
+            out.write(json.dumps(record) + "\n")
+            # flush + fsync so a crash never loses a finished run
+            out.flush()
+            os.fsync(out.fileno())
+            if record["status"] == "ok":
+                self.completed += 1
+            else:
+                self.failed += 1
+                print(f"[{record['id']}] failed: {record['error']}", file=sys.stderr)
+            if (self.completed + self.failed) % 10 == 0:
+                self.report_progress()
+
+    def report_progress(self, final: bool = False) -> None:
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        finished = self.completed + self.failed
+        rate = finished / elapsed * 60
+        prefix = "Finished" if final else "Progress"
+        print(f"{prefix}: {finished}/{self.total} ({self.failed} failed) in {elapsed:.0f}s, {rate:.1f} URLs/min")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Research a JSONL file of product links.")
+    parser.add_argument("input", help="JSONL file with one product link per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file the results are appended to (default: results.jsonl)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="number of products researched at the same time (default: 4)")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached reports and research every product again")
+    parser.add_argument("--refresh", action="store_true",
+                        help="update the stored reports with evidence published since they were made instead of researching from scratch")
+    parser.add_argument("--run", help="name of the refresh run records are resumed by (default: today's UTC date)")
+    args = parser.parse_args(argv)
+
+    run = (args.run or datetime.now(timezone.utc).date().isoformat()) if args.refresh else None
+    inputs = read_inputs(args.input)
+    # records of a research (or another refresh run) must not skip the products of this refresh
+    done = read_done(args.output, run)
+    todo = []
+    seen = set(done)
+    for item in inputs:
+        key = canonicalize_url(item["url"]).key
+        # skip finished products, and the same product listed twice in the input
+        if key not in seen:
+            seen.add(key)
+            todo.append(item)
+    print(f"{len(inputs)} links, {len(inputs) - len(todo)} already done or repeated, {len(todo)} to research")
+
+    runner = BatchRunner(args.output, concurrency=args.concurrency, use_cache=not args.no_cache, refresh=args.refresh, run=run)
+    asyncio.run(runner.run(todo))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Offline benchmark of the research graph with stub LLM and search backends (no API keys, no network).
+
+    python benchmark.py -o bench.json                  # run and save the results
+    python benchmark.py -o new.json --compare bench.json  # run and show the change against an older run
+
+The stubs are deterministic and every run uses the same seeds, so results of two commits
+measured with the same options on the same machine can be compared directly.
+"""
+import os
+import sys
+import json
+import hashlib
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Any, Dict, List, Optional
+
+# Everything the graph persists goes to a throw-away directory and the search cache is off,
+# otherwise the second iteration would only measure cache hits.
+_tmp = tempfile.mkdtemp(prefix="bench-")
+os.environ["CACHE_DIR"] = _tmp
+os.environ["CHECKPOINT_PATH"] = os.path.join(_tmp, "checkpoints.sqlite")
+os.environ["SEARCH_CACHE"] = "0"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "tvly-benchmark")
+os.environ.pop("METRICS_PORT", None)
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import nodes
+from fetcher import FetchResult
+from metrics import registry, llm_callback
+
+WORDS = ("battery sound comfort build noise canceling app price case hinge bass treble call quality microphone "
+         "bluetooth multipoint latency warranty return fit weight charging durable cheap premium worth issue").split()
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+class StubChatModel(BaseChatModel):
+    """Deterministic chat model: answers the analysis prompt with JSON, the report prompt with markdown."""
+
+    latency: float = 0.0        # seconds before the first token
+    report_chars: int = 3000
+    chunk_chars: int = 20       # size of the streamed pieces
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-stub"
+
+    def _answer(self, messages) -> str:
+        prompt = "\n".join(str(m.content) for m in messages)
+        rng = random.Random(len(prompt))
+        if "Return a valid JSON object" in prompt:
+            return json.dumps({
+                "positive_topics": ["sound", "comfort"], "negative_topics": ["price"],
+                "rating_distribution": {"5": 60, "4": 20, "3": 10, "2": 5, "1": 5},
+                "average_rating": 4.2, "total_reviews": 120,
+            })
+        if "product research analyst" in prompt:
+            return "# Product Report\n\n" + _text(rng, self.report_chars)
+        if "Distill the following conversation" in prompt:
+            return "Summary: " + _text(rng, 300)
+        return _text(rng, 400)
+
+    def bind_tools(self, tools, **kwargs):
+        # the stub never calls tools
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._answer(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._answer(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        text = self._answer(messages)
+        for i in range(0, len(text), self.chunk_chars):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + self.chunk_chars]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class StubTavily:
+    """Deterministic search backend, results depend only on the query."""
+
+    def __init__(self, latency: float = 0.0, results: int = 5, payload_chars: int = 800):
+        self.latency = latency
+        self.results = results
+        self.payload_chars = payload_chars
+
+    def _response(self, query: str) -> Dict[str, Any]:
+        rng = random.Random(query)
+        return {"results": [
+            {
+                "title": f"Result {i}",
+                "url": f"https://example.com/{hashlib.sha1(query.encode()).hexdigest()[:8]}/{i}",
+                "content": _text(rng, self.payload_chars),
+                "score": round(rng.uniform(0.3, 0.9), 3),
+            }
+            for i in range(self.results)
+        ]}
+
+    def search(self, query: str, **kwargs) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        return self._response(query)
+
+
+class StubAsyncTavily(StubTavily):
+    async def search(self, query: str, **kwargs) -> Dict[str, Any]:
+        await asyncio.sleep(self.latency)
+        return self._response(query)
+
+
+def install_stubs(llm_latency: float, search_latency: float, results: int, payload_chars: int) -> None:
+    """Points nodes.py at the stubs (the graph looks these up at call time)."""
+    llm = StubChatModel(latency=llm_latency, callbacks=[llm_callback])
+    tavily = StubTavily(search_latency, results, payload_chars)
+    async_tavily = StubAsyncTavily(search_latency, results, payload_chars)
+    nodes.get_llm = lambda: llm
+    nodes.get_tavily = lambda: tavily
+    nodes.get_async_tavily = lambda: async_tavily
+    nodes.fetch_title = lambda url, **kwargs: FetchResult(200, f"Amazon.com: Benchmark Product {url[-4:]} Headphones : Electronics", 50_000, False)
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        "mean": statistics.mean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))],
+        "min": values[0],
+        "max": values[-1],
+    }
+
+
+def bench_end_to_end(app, iterations: int) -> Dict[str, Any]:
+    """Full research runs (sync and async) on fresh threads and products.
+
+    The async runs use other product ids than the sync ones, else they would resolve the product
+    from the catalog the sync runs filled and skip the page fetch and title step.
+    """
+    from service import initial_state
+
+    sync_times, async_times = [], []
+    for i in range(iterations):
+        config = {"configurable": {"thread_id": f"bench-e2e-{i}"}}
+        start = time.perf_counter()
+        app.invoke(initial_state(f"https://www.amazon.com/dp/B0BENCH{i:03d}"), config=config)
+        sync_times.append(time.perf_counter() - start)
+
+    async def run_async():
+        for i in range(iterations):
+            config = {"configurable": {"thread_id": f"bench-e2e-async-{i}"}}
+            start = time.perf_counter()
+            await app.ainvoke(initial_state(f"https://www.amazon.com/dp/B0BENCA{i:03d}"), config=config)
+            async_times.append(time.perf_counter() - start)
+
+    asyncio.run(run_async())
+    return {"sync_seconds": _summary(sync_times), "async_seconds": _summary(async_times)}
+
+
+def node_breakdown() -> Dict[str, Any]:
+    """p50/p95 wall time per node from the metrics registry."""
+    breakdown = {}
+    for item in registry.snapshot()["summaries"].get("node_seconds", []):
+        node = item["labels"]["node"]
+        breakdown[node] = {
+            "count": item["count"],
+            "mean": item["sum"] / item["count"],
+            "p50": item["quantiles"]["0.5"],
+            "p95": item["quantiles"]["0.95"],
+        }
+    return breakdown
+
+
+def bench_state_growth(app, sizes: List[int], payload_chars: int) -> Dict[str, Any]:
+    """Cost of merging research_evidence through its reducer and checkpointing it, as the list grows."""
+    from evidence_store import store_evidence
+
+    rng = random.Random(7)
+    results = {}
+    for size in sizes:
+        evidence = [
+            {"source": "web", "content": _text(rng, payload_chars), "url": f"https://example.com/{size}/{i}", "metadata": {"title": ""}}
+            for i in range(size)
+        ]
+        config = {"configurable": {"thread_id": f"bench-state-{size}"}}
+        start = time.perf_counter()
+        # the state only carries refs, storing the bodies is part of the write
+        refs = store_evidence(evidence)
+        app.update_state(config, {"product_link": "https://example.com", "research_evidence": refs}, as_node="research_subgraph")
+        write = time.perf_counter() - start
+        # a second write on top of the stored list goes through the operator.add reducer
+        start = time.perf_counter()
+        app.update_state(config, {"research_evidence": refs[:1]}, as_node="research_subgraph")
+        append = time.perf_counter() - start
+        start = time.perf_counter()
+        app.get_state(config)
+        read = time.perf_counter() - start
+        size_bytes = app.checkpointer.conn.execute(
+            "SELECT length(checkpoint) FROM checkpoints WHERE thread_id = ? ORDER BY checkpoint_id DESC LIMIT 1",
+            (config["configurable"]["thread_id"],),
+        ).fetchone()
+        results[str(size)] = {
+            "write_seconds": write,
+            "append_seconds": append,
+            "read_seconds": read,
+            "checkpoint_bytes": size_bytes[0] if size_bytes else None,
+        }
+    return results
+
+
+def bench_chat(app, turns: int) -> Dict[str, Any]:
+    """Latency of each follow-up turn on one thread, to see how it grows with the conversation."""
+    from service import initial_state, stream_chat
+    from summarizer import wait_for_summaries
+
+    config = {"configurable": {"thread_id": "bench-chat"}}
+    app.invoke(initial_state("https://www.amazon.com/dp/B0BENCHCHT"), config=config)
+    per_turn = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        # the background summary is not part of the turn, like in the UI
+        for _ in stream_chat(f"Question {turn}: how is the battery life?", config):
+            pass
+        per_turn.append(time.perf_counter() - start)
+    wait_for_summaries()
+    values = app.get_state(config).values
+    return {"turn_seconds": per_turn, "summary": _summary(per_turn),
+            "messages_left": len(values["messages"]), "summarized": bool(values.get("summary"))}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    """Prints the relative change of the headline numbers."""
+    def change(a, b):
+        return f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+
+    print(f"\nChange from {old.get('commit')} to {new.get('commit')}:")
+    for mode in ("sync_seconds", "async_seconds"):
+        a = old["end_to_end"][mode]["p50"]
+        b = new["end_to_end"][mode]["p50"]
+        print(f"  end to end {mode[:-8]:5} p50: {a * 1000:8.1f} ms -> {b * 1000:8.1f} ms ({change(a, b)})")
+    for node, stats in sorted(new["nodes"].items()):
+        if node in old["nodes"]:
+            a, b = old["nodes"][node]["p50"], stats["p50"]
+            print(f"  node {node:25} p50: {a * 1000:8.2f} ms -> {b * 1000:8.2f} ms ({change(a, b)})")
+    for size, stats in new["state_growth"].items():
+        if size in old["state_growth"]:
+            a, b = old["state_growth"][size]["write_seconds"], stats["write_seconds"]
+            print(f"  checkpoint write, {size:>5} items: {a * 1000:8.2f} ms -> {b * 1000:8.2f} ms ({change(a, b)})")
+    a, b = old["chat"]["summary"]["p50"], new["chat"]["summary"]["p50"]
+    print(f"  chat turn p50: {a * 1000:8.1f} ms -> {b * 1000:8.1f} ms ({change(a, b)})")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the research graph.")
+    parser.add_argument("-n", "--iterations", type=int, default=5, help="research runs per mode (default: 5)")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call (default: 0)")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="simulated seconds per search (default: 0)")
+    parser.add_argument("--results", type=int, default=5, help="results per search (default: 5)")
+    parser.add_argument("--payload-chars", type=int, default=800, help="characters per search result (default: 800)")
+    parser.add_argument("--evidence-sizes", default="10,100,1000", help="evidence list sizes for the state benchmark")
+    parser.add_argument("--chat-turns", type=int, default=10, help="follow-up turns in the chat benchmark (default: 10)")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    install_stubs(args.llm_latency, args.search_latency, args.results, args.payload_chars)
+    from graph import app
+
+    registry.reset()
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "options": vars(args),
+        "end_to_end": bench_end_to_end(app, args.iterations),
+        "nodes": node_breakdown(),
+        "state_growth": bench_state_growth(app, [int(s) for s in args.evidence_sizes.split(",")], args.payload_chars),
+        "chat": bench_chat(app, args.chat_turns),
+    }
+
+    e2e = results["end_to_end"]
+    print(f"End to end p50: sync {e2e['sync_seconds']['p50'] * 1000:.1f} ms, async {e2e['async_seconds']['p50'] * 1000:.1f} ms")
+    for node, stats in sorted(results["nodes"].items(), key=lambda x: -x[1]["p50"]):
+        print(f"  {node:25} p50 {stats['p50'] * 1000:8.2f} ms  p95 {stats['p95'] * 1000:8.2f} ms  ({stats['count']} runs)")
+    for size, stats in results["state_growth"].items():
+        print(f"State with {size:>5} evidence items: write {stats['write_seconds'] * 1000:.2f} ms, "
+              f"append {stats['append_seconds'] * 1000:.2f} ms, read {stats['read_seconds'] * 1000:.2f} ms, "
+              f"{(stats['checkpoint_bytes'] or 0) / 1024:.0f} KB")
+    turns = results["chat"]["turn_seconds"]
+    print(f"Chat turns: first {turns[0] * 1000:.1f} ms, last {turns[-1] * 1000:.1f} ms, p50 {results['chat']['summary']['p50'] * 1000:.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
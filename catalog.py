@@ -0,0 +1,277 @@
+"""Local product catalog, maps retailer product ids (ASIN, SKU, ...) to product names.
+
+It is filled by every successful parse_link and can be bulk loaded from a feed, so known
+products are resolved without fetching the page or asking the LLM.
+
+    python catalog.py load feed.jsonl    # JSONL or CSV rows with url (or retailer + product_id) and name
+    python catalog.py lookup <url>
+    python catalog.py search <words>
+"""
+import os
+import re
+import csv
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+from storage import connect, db_path
+from url_canonical import CanonicalProduct, canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+# Ratings and prices move, page data older than this is not used for a product resolved from the catalog
+DATA_MAX_AGE = float(os.environ.get("CATALOG_DATA_MAX_AGE_HOURS", "24")) * 60 * 60
+# A slug only resolves to a catalog product when it has this many meaningful words and they
+# make up at least this share of the product's name, one generic word ("black", "case") matches anything
+MATCH_MIN_WORDS = 2
+MATCH_MIN_COVERAGE = float(os.environ.get("CATALOG_MATCH_MIN_COVERAGE", "0.5"))
+SLUG_NOISE = set("""a an and by for in of on the to with buy shop store product products item items p dp ip site html htm
+php aspx www com new sale""".split())
+# Feed columns we understand, the first one present wins
+NAME_FIELDS = ("name", "title", "product_name")
+ID_FIELDS = ("product_id", "asin", "sku", "id")
+# Links the canonicalizer understands, used for feed rows that only have retailer + id
+CANONICAL_LINKS = {
+    "amazon": "https://www.amazon.com/dp/{id}",
+    "bestbuy": "https://www.bestbuy.com/site/{id}.p",
+    "walmart": "https://www.walmart.com/ip/{id}",
+    "flipkart": "https://www.flipkart.com/p/{id}",
+    "target": "https://www.target.com/p/A-{id}",
+    "ebay": "https://www.ebay.com/itm/{id}",
+    "newegg": "https://www.newegg.com/p/{id}",
+}
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def _fts_query(text: str) -> str:
+    """Quotes every word so user text cannot break the FTS syntax, the words are ANDed."""
+    return " ".join(f'"{word}"' for word in _words(text))
+
+
+class Catalog:
+    """SQLite table of products keyed by canonical url key, with an FTS5 index over the names.
+
+    Lookups by key go through a small in-memory LRU, the FTS index is only used for
+    free-text search (URLs without a product id, the CLI).
+    """
+
+    def __init__(self, path: str, max_memory_entries: int = 2048):
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS products (
+                key TEXT PRIMARY KEY,
+                retailer TEXT NOT NULL,
+                product_id TEXT,
+                name TEXT NOT NULL,
+                source TEXT,
+                updated_at REAL NOT NULL,
+                data TEXT,
+                data_at REAL
+            )"""
+        )
+        # catalogs created before the product page data was kept
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(products)")]
+        if "data" not in columns:
+            self._conn.execute("ALTER TABLE products ADD COLUMN data TEXT")
+            self._conn.execute("ALTER TABLE products ADD COLUMN data_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS products_id ON products (retailer, product_id)")
+        # Not every SQLite build has FTS5, search falls back to LIKE then
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(name, content='products', content_rowid='rowid')"
+            )
+            self._conn.executescript(
+                """CREATE TRIGGER IF NOT EXISTS products_ai AFTER INSERT ON products BEGIN
+                    INSERT INTO products_fts (rowid, name) VALUES (new.rowid, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS products_ad AFTER DELETE ON products BEGIN
+                    INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS products_au AFTER UPDATE ON products BEGIN
+                    INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+                    INSERT INTO products_fts (rowid, name) VALUES (new.rowid, new.name);
+                END;"""
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5, catalog search falls back to LIKE")
+            self.fts = False
+        self._conn.commit()
+
+    def lookup(self, product: CanonicalProduct) -> Optional[str]:
+        """Returns the name stored for the product, by url key or else by retailer + product id (other marketplaces)."""
+        with self._lock:
+            if product.key in self._memory:
+                self._memory.move_to_end(product.key)
+                return self._memory[product.key]
+            row = self._conn.execute("SELECT name FROM products WHERE key = ?", (product.key,)).fetchone()
+            if row is None and product.product_id:
+                row = self._conn.execute(
+                    "SELECT name FROM products WHERE retailer = ? AND product_id = ? ORDER BY updated_at DESC LIMIT 1",
+                    (product.retailer, product.product_id),
+                ).fetchone()
+            if row is None:
+                return None
+            self._remember(product.key, row[0])
+            return row[0]
+
+    def put(self, product: CanonicalProduct, name: str, source: str = "", data: Optional[Dict[str, Any]] = None) -> None:
+        """Stores the product name, and the structured data of its page if we read it (see structured_data.py)."""
+        self.put_many([(product, name)], source)
+        if data:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE products SET data = ?, data_at = ? WHERE key = ?", (json.dumps(data), time.time(), product.key)
+                )
+                self._conn.commit()
+
+    def product_data(self, product: CanonicalProduct, max_age: float = DATA_MAX_AGE) -> Optional[Dict[str, Any]]:
+        """The structured page data stored with the product, if it is younger than max_age seconds."""
+        with self._lock:
+            row = self._conn.execute("SELECT data, data_at FROM products WHERE key = ?", (product.key,)).fetchone()
+        if row is None or not row[0] or time.time() - row[1] > max_age:
+            return None
+        return json.loads(row[0])
+
+    def put_many(self, items: List, source: str = "") -> int:
+        """Stores (product, name) pairs, a newer name for a known key replaces the old one."""
+        now = time.time()
+        rows = [(p.key, p.retailer, p.product_id, name.strip(), source, now) for p, name in items if name and name.strip()]
+        with self._lock:
+            # upsert instead of INSERT OR REPLACE, a replace would delete the row without firing the FTS update trigger
+            self._conn.executemany(
+                """INSERT INTO products (key, retailer, product_id, name, source, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET name = excluded.name, source = excluded.source, updated_at = excluded.updated_at""",
+                rows,
+            )
+            self._conn.commit()
+            for key, _, _, name, _, _ in rows:
+                self._remember(key, name)
+        return len(rows)
+
+    def search(self, text: str, limit: int = 5) -> List[Dict[str, str]]:
+        """Products whose name has all the words of text, best match first."""
+        words = _words(text)
+        if not words:
+            return []
+        with self._lock:
+            if self.fts:
+                rows = self._conn.execute(
+                    """SELECT p.key, p.retailer, p.product_id, p.name FROM products_fts f JOIN products p ON p.rowid = f.rowid
+                    WHERE products_fts MATCH ? ORDER BY bm25(products_fts) LIMIT ?""",
+                    (_fts_query(text), limit),
+                ).fetchall()
+            else:
+                where = " AND ".join("lower(name) LIKE ?" for _ in words)
+                rows = self._conn.execute(
+                    f"SELECT key, retailer, product_id, name FROM products WHERE {where} ORDER BY length(name) LIMIT ?",
+                    [f"%{word}%" for word in words] + [limit * 10],
+                ).fetchall()
+                # LIKE also matches inside words ("pro" in "protector"), keep whole word matches only
+                rows = [row for row in rows if set(words) <= set(_words(row[3]))][:limit]
+        return [{"key": key, "retailer": retailer, "product_id": pid, "name": name} for key, retailer, pid, name in rows]
+
+    def match(self, text: str) -> Optional[Dict[str, str]]:
+        """The product a url slug (or other short text) most likely names, None unless the match is clear.
+
+        The text needs MATCH_MIN_WORDS meaningful words and they have to cover MATCH_MIN_COVERAGE of
+        the product name, so "black" or "pro-case" does not pick some product that happens to contain them.
+        """
+        words = [word for word in dict.fromkeys(_words(text)) if word not in SLUG_NOISE and len(word) > 1]
+        if len(words) < MATCH_MIN_WORDS:
+            return None
+        for row in self.search(" ".join(words), limit=5):
+            name_words = set(_words(row["name"]))
+            if name_words and len(name_words & set(words)) / len(name_words) >= MATCH_MIN_COVERAGE:
+                return row
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            return {"entries": rows, "memory_entries": len(self._memory)}
+
+    def _remember(self, key: str, name: str) -> None:
+        self._memory[key] = name
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+def read_feed(path: str) -> Iterator:
+    """Yields (product, name) from a JSONL or CSV feed, rows without a usable id or name are skipped."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            row = {k.lower(): v for k, v in row.items() if v}
+            name = next((row[k] for k in NAME_FIELDS if k in row), None)
+            if not name:
+                continue
+            if row.get("url"):
+                product = canonicalize_url(row["url"])
+            else:
+                retailer = (row.get("retailer") or "").lower()
+                product_id = next((str(row[k]) for k in ID_FIELDS if k in row), None)
+                if not retailer or not product_id:
+                    continue
+                # the canonicalizer builds the same key a link to the product would get
+                product = canonicalize_url(CANONICAL_LINKS.get(retailer, "").format(id=product_id))
+                if product.product_id is None:
+                    continue
+            yield product, str(name)
+
+
+def load_feed(catalog: Catalog, path: str, batch_size: int = 1000) -> int:
+    """Bulk loads a feed file into the catalog, returns the number of products stored."""
+    loaded, batch = 0, []
+    for item in read_feed(path):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            loaded += catalog.put_many(batch, "feed")
+            batch = []
+    if batch:
+        loaded += catalog.put_many(batch, "feed")
+    return loaded
+
+
+_catalog: Optional[Catalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> Catalog:
+    """Returns the shared product catalog."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(os.environ.get("CATALOG_PATH") or db_path("catalog.sqlite"))
+    return _catalog
+
+
+if __name__ == "__main__":
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 2 else (None, [])
+    if command == "load":
+        for path in args:
+            print(f"Loaded {load_feed(get_catalog(), path)} products from {path}")
+    elif command == "lookup":
+        product = canonicalize_url(args[0])
+        print(f"{product.key}: {get_catalog().lookup(product) or 'not in the catalog'}")
+    elif command == "search":
+        for row in get_catalog().search(" ".join(args)):
+            print(f"{row['key']}\t{row['name']}")
+    else:
+        print(__doc__)
+        sys.exit(1)
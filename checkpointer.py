@@ -0,0 +1,198 @@
+"""SQLite checkpointer with retention, so chat threads survive restarts without growing forever.
+
+    python checkpointer.py compact     # prune + expire idle threads + VACUUM
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from storage import connect, db_path
+from metrics import registry
+
+HOUR = 60 * 60
+
+# Only the newest checkpoints of a thread are needed to continue the chat, older ones are only history
+KEEP_LAST = int(os.environ.get("CHECKPOINT_KEEP_LAST", "3"))
+# Threads nobody touched for this long are deleted
+MAX_IDLE = float(os.environ.get("CHECKPOINT_MAX_IDLE_HOURS", "72")) * HOUR
+# Idle threads are expired every this many checkpoint writes
+EXPIRE_EVERY = 500
+
+
+class RetentionSqliteSaver(SqliteSaver):
+    """SqliteSaver that keeps only the latest checkpoints per thread and expires idle threads.
+
+    The async methods run the sync ones in a worker thread, so the same saver also works with app.ainvoke/app.astream.
+    """
+
+    def __init__(self, conn, *, keep_last: int = KEEP_LAST, max_idle: float = MAX_IDLE, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.keep_last = keep_last
+        self.max_idle = max_idle
+        self._puts = 0
+        self._puts_lock = threading.Lock()
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        super().setup()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+        self.conn.commit()
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        start = time.perf_counter()
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        registry.observe("checkpoint_write_seconds", time.perf_counter() - start)
+        thread_id = str(config["configurable"]["thread_id"])
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO thread_activity (thread_id, last_seen) VALUES (?, ?)",
+                (thread_id, time.time()),
+            )
+            size = cur.execute(
+                "SELECT length(checkpoint) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, saved["configurable"]["checkpoint_ns"], saved["configurable"]["checkpoint_id"]),
+            ).fetchone()
+        if size:
+            registry.observe("checkpoint_bytes", size[0])
+        self.prune_thread(thread_id, config["configurable"].get("checkpoint_ns", ""))
+
+        with self._puts_lock:
+            self._puts += 1
+            expire = self._puts % EXPIRE_EVERY == 0
+        if expire:
+            self.expire_idle_threads()
+        return saved
+
+    def prune_thread(self, thread_id: str, checkpoint_ns: str = "") -> None:
+        """Deletes all but the newest keep_last checkpoints of the thread (checkpoint ids are time ordered)."""
+        with self.cursor() as cur:
+            cur.execute(
+                """DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN (
+                    SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                    ORDER BY checkpoint_id DESC LIMIT ?
+                )""",
+                (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.keep_last),
+            )
+            if checkpoint_ns == "":
+                # subgraph checkpoints (research_subgraph) older than the newest root checkpoint belong to finished runs
+                cur.execute(
+                    """DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns != '' AND checkpoint_id < (
+                        SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''
+                    )""",
+                    (thread_id, thread_id),
+                )
+            cur.execute(
+                """DELETE FROM writes WHERE thread_id = ? AND NOT EXISTS (
+                    SELECT 1 FROM checkpoints c WHERE c.thread_id = writes.thread_id
+                    AND c.checkpoint_ns = writes.checkpoint_ns AND c.checkpoint_id = writes.checkpoint_id
+                )""",
+                (thread_id,),
+            )
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM thread_activity WHERE thread_id = ?", (str(thread_id),))
+
+    def expire_idle_threads(self, max_idle: Optional[float] = None) -> int:
+        """Deletes every thread that was not written for max_idle seconds and returns how many were deleted."""
+        max_idle = self.max_idle if max_idle is None else max_idle
+        with self.cursor() as cur:
+            rows = cur.execute(
+                "SELECT thread_id FROM thread_activity WHERE last_seen < ?", (time.time() - max_idle,)
+            ).fetchall()
+        for (thread_id,) in rows:
+            self.delete_thread(thread_id)
+        return len(rows)
+
+    def compact(self) -> Tuple[int, int]:
+        """Prunes every thread, expires idle ones and gives the freed pages back to the OS.
+
+        Returns (threads expired, bytes reclaimed).
+        """
+        expired = self.expire_idle_threads()
+        with self.cursor() as cur:
+            threads = cur.execute("SELECT DISTINCT thread_id, checkpoint_ns FROM checkpoints").fetchall()
+        for thread_id, checkpoint_ns in threads:
+            self.prune_thread(thread_id, checkpoint_ns)
+        with self.lock:
+            before = self._size()
+            self.conn.commit()
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.execute("VACUUM")
+            after = self._size()
+        return expired, before - after
+
+    def _size(self) -> int:
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    # async versions, SqliteSaver only has sync ones
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def get_checkpointer():
+    """Returns the checkpointer for the app (CHECKPOINTER=memory gives the old in-process MemorySaver)."""
+    if os.environ.get("CHECKPOINTER") == "memory":
+        from langgraph.checkpoint.memory import MemorySaver
+        return MemorySaver()
+    path = os.environ.get("CHECKPOINT_PATH") or db_path("checkpoints.sqlite")
+    return RetentionSqliteSaver(connect(path))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["compact"]:
+        print(__doc__)
+        sys.exit(1)
+    saver = get_checkpointer()
+    expired, reclaimed = saver.compact()
+    print(f"Expired {expired} idle threads, reclaimed {reclaimed / 1024:.0f} KB")
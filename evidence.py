@@ -0,0 +1,256 @@
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+from state import ResearchEvidence
+from url_canonical import canonicalize_url
+
+# Two snippets sharing this fraction of their word shingles (or one mostly contained in the other) are the same text
+NEAR_DUPLICATE_JACCARD = float(os.environ.get("NEAR_DUPLICATE_JACCARD", "0.6"))
+NEAR_DUPLICATE_CONTAINMENT = 0.8
+
+# Size of one chunk in the map-reduce sentiment stage
+CHUNK_TOKEN_BUDGET = int(os.environ.get("CHUNK_TOKEN_BUDGET", "2500"))
+
+# Token budget for the evidence block that harvest_reviews and generate_report put in their prompts
+EVIDENCE_TOKEN_BUDGET = int(os.environ.get("EVIDENCE_TOKEN_BUDGET", "4000"))
+
+_encodings = {}
+
+
+def _encoding(model: str):
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # tiktoken is missing or could not download its encoding files (offline machine)
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Counts tokens the way the target model does (falls back to ~4 characters per token without tiktoken)."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _terms(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if len(t) > 1]
+
+
+def relevance(item: ResearchEvidence, query: str) -> float:
+    """Scores how useful a snippet is for the product: query term coverage, review words and Tavily's own score."""
+    content = item.get("content") or ""
+    terms = Counter(_terms(content))
+    query_terms = set(_terms(query))
+    coverage = sum(1 for t in query_terms if terms[t]) / len(query_terms) if query_terms else 0.0
+    opinion = sum(terms[w] for w in ("review", "pros", "cons", "battery", "quality", "worth", "issue", "problem",
+                                     "recommend", "love", "hate", "broke", "returned", "rating", "stars"))
+    search_score = float((item.get("metadata") or {}).get("score") or 0.0)
+    # longer snippets carry more information, but only up to a point
+    length = min(len(content), 1500) / 1500
+    return 2.0 * coverage + 0.1 * min(opinion, 10) + search_score + 0.5 * length
+
+
+def format_evidence(item: ResearchEvidence) -> str:
+    return f"[{item['source']}] {item['content']}"
+
+
+def _cut_tokens(text: str, budget: int, model: str) -> str:
+    """Hard cut after budget tokens (about 4 characters per token without tiktoken)."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return text[:budget * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+
+
+def _trim_to_tokens(text: str, budget: int, model: str) -> str:
+    """Cuts the text at the last sentence end that fits in the budget, so we never cut a quote in half.
+
+    If not even the first sentence fits (one endless sentence, a scraped table) it is cut at the
+    token level instead, a snippet is never dropped as a whole.
+    """
+    sentences = re.split(r"(?<=[.!?])\s+", text)
+    kept = []
+    used = 0
+    for sentence in sentences:
+        cost = count_tokens(sentence + " ", model)
+        if used + cost > budget:
+            break
+        kept.append(sentence)
+        used += cost
+    if not kept and budget > 0:
+        return _cut_tokens(text, budget, model).rstrip()
+    return " ".join(kept)
+
+
+def pack_evidence_text(
+    evidence: List[ResearchEvidence],
+    query: str,
+    budget: int = EVIDENCE_TOKEN_BUDGET,
+    model: str = "gpt-4o-mini",
+) -> str:
+    """Packs the most relevant snippets into the token budget, giving every source a fair share of it.
+
+    Every source first gets budget / number_of_sources tokens for its best snippets, whatever a source
+    does not use is handed to the best remaining snippets of any source.
+    """
+    if not evidence:
+        return ""
+
+    by_source: Dict[str, List[ResearchEvidence]] = {}
+    for item in evidence:
+        if item.get("content"):
+            by_source.setdefault(item["source"], []).append(item)
+    for items in by_source.values():
+        items.sort(key=lambda e: relevance(e, query), reverse=True)
+
+    share = budget // max(len(by_source), 1)
+    picked: List[Optional[str]] = []
+    leftovers = []
+    used = 0
+
+    # first pass: fair share per source
+    for source, items in by_source.items():
+        source_used = 0
+        for item in items:
+            line = format_evidence(item)
+            cost = count_tokens(line, model) + 1
+            if source_used + cost <= share:
+                picked.append(line)
+                source_used += cost
+            elif source_used == 0 and share > 50:
+                # the best snippet alone is larger than the share, keep its first sentences
+                line = _trim_to_tokens(line, share, model)
+                if line:
+                    picked.append(line)
+                    source_used += count_tokens(line, model) + 1
+            else:
+                leftovers.append((relevance(item, query), line, cost))
+        used += source_used
+
+    # second pass: spend what is left on the best remaining snippets of any source
+    leftovers.sort(key=lambda x: x[0], reverse=True)
+    for _, line, cost in leftovers:
+        if used + cost <= budget:
+            picked.append(line)
+            used += cost
+
+    return "\n".join(picked)
+
+
+def shingles(text: str, size: int = 3) -> Set[str]:
+    """Word shingles of the text, mirrored copies of a review share most of them even after small edits."""
+    words = _terms(text)
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(a: Set[str], b: Set[str], jaccard: float = NEAR_DUPLICATE_JACCARD) -> bool:
+    overlap = len(a & b)
+    if not overlap:
+        return False
+    if overlap / len(a | b) >= jaccard:
+        return True
+    # a syndicated excerpt is usually a chunk of the full review (too short snippets prove nothing)
+    smaller = min(len(a), len(b))
+    return smaller >= 8 and overlap / smaller >= NEAR_DUPLICATE_CONTAINMENT
+
+
+def _merge_provenance(kept: ResearchEvidence, duplicate: ResearchEvidence) -> None:
+    metadata = kept["metadata"]
+    if duplicate["source"] not in metadata["sources"]:
+        metadata["sources"].append(duplicate["source"])
+    if duplicate.get("url") and duplicate["url"] not in metadata["urls"]:
+        metadata["urls"].append(duplicate["url"])
+    # keep the longer copy of the text
+    if len(duplicate.get("content") or "") > len(kept.get("content") or ""):
+        kept["content"] = duplicate["content"]
+
+
+def dedupe_evidence(evidence: List[ResearchEvidence], jaccard: float = NEAR_DUPLICATE_JACCARD) -> List[ResearchEvidence]:
+    """Drops repeated snippets (same canonical URL or near identical text) and records every source that returned them.
+
+    The surviving items get metadata["sources"] and metadata["urls"] listing all the copies that were merged into them.
+    """
+    unique: List[ResearchEvidence] = []
+    by_url: Dict[str, ResearchEvidence] = {}
+    fingerprints = []
+
+    for item in evidence:
+        if not item.get("content"):
+            continue
+        url_key = canonicalize_url(item["url"]).key if item.get("url") else None
+        if url_key and url_key in by_url:
+            _merge_provenance(by_url[url_key], item)
+            continue
+
+        fingerprint = shingles(item["content"])
+        duplicate_of = None
+        for other_fingerprint, other in fingerprints:
+            if is_near_duplicate(fingerprint, other_fingerprint, jaccard):
+                duplicate_of = other
+                break
+        if duplicate_of is not None:
+            _merge_provenance(duplicate_of, item)
+            if url_key:
+                by_url[url_key] = duplicate_of
+            continue
+
+        kept = ResearchEvidence(
+            source=item["source"],
+            content=item["content"],
+            url=item.get("url"),
+            metadata=dict(item.get("metadata") or {}, sources=[item["source"]], urls=[item["url"]] if item.get("url") else []),
+        )
+        unique.append(kept)
+        fingerprints.append((fingerprint, kept))
+        if url_key:
+            by_url[url_key] = kept
+
+    return unique
+
+
+def chunk_evidence(
+    evidence: List[ResearchEvidence],
+    max_tokens: int = CHUNK_TOKEN_BUDGET,
+    model: str = "gpt-4o-mini",
+) -> List[str]:
+    """Splits all the evidence into prompt sized chunks, one source per chunk, every snippet ends up in one.
+
+    A snippet larger than max_tokens is trimmed to fit a chunk of its own, at the last sentence end
+    that fits or mid-sentence when even the first sentence is too long, so its tail is lost.
+    """
+    chunks = []
+    by_source: Dict[str, List[ResearchEvidence]] = {}
+    for item in evidence:
+        if item.get("content"):
+            by_source.setdefault(item["source"], []).append(item)
+
+    for items in by_source.values():
+        lines: List[str] = []
+        used = 0
+        for item in items:
+            line = format_evidence(item)
+            cost = count_tokens(line, model) + 1
+            if lines and used + cost > max_tokens:
+                chunks.append("\n".join(lines))
+                lines, used = [], 0
+            if cost > max_tokens:
+                line = _trim_to_tokens(line, max_tokens, model)
+                cost = max_tokens
+            if not line.strip():
+                continue
+            lines.append(line)
+            used += cost
+        if lines:
+            chunks.append("\n".join(lines))
+    return chunks
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from state import ResearchEvidence
+from storage import connect, db_path
+
+logger = logging.getLogger(__name__)
+
+# Evidence nobody stored or loaded for this long is deleted unless a stored report pins it
+# (threads idle for 72h are expired already, see checkpointer.py)
+DEFAULT_MAX_AGE = float(os.environ.get("EVIDENCE_MAX_AGE_DAYS", "30")) * 24 * 60 * 60
+# Decoded evidence kept in memory, chat turns and the report nodes of a run mostly hit this
+MEMORY_ENTRIES = int(os.environ.get("EVIDENCE_MEMORY_ENTRIES", "5000"))
+PRUNE_EVERY = 1000
+# Reads served from memory update last_used in the database at most this often per ref
+TOUCH_EVERY = 60 * 60
+
+
+def evidence_ref(item: ResearchEvidence) -> str:
+    """Returns the content hash a piece of evidence is stored under."""
+    body = json.dumps(item, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()[:32]
+
+
+class EvidenceStore:
+    """SQLite store of evidence bodies keyed by content hash.
+
+    Graph state only carries the hashes (refs), so checkpoints do not copy the evidence text
+    at every step and chat turn. Identical evidence from different runs is stored once.
+    Refs pinned by an owner (the report cache) are never pruned, the rest once unused for max_age.
+    """
+
+    def __init__(self, path: str, max_age: float = DEFAULT_MAX_AGE, memory_entries: int = MEMORY_ENTRIES):
+        self.max_age = max_age
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, ResearchEvidence]" = OrderedDict()
+        self._touched: "OrderedDict[str, float]" = OrderedDict()
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS evidence (
+                ref TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS evidence_pins (
+                owner TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                PRIMARY KEY (owner, ref)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS evidence_pins_ref ON evidence_pins (ref)")
+        self._conn.commit()
+
+    def _remember(self, ref: str, item: ResearchEvidence) -> None:
+        self._memory[ref] = item
+        self._memory.move_to_end(ref)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def put_many(self, items: List[ResearchEvidence]) -> List[str]:
+        """Stores the evidence and returns its refs, in the same order."""
+        refs = [evidence_ref(item) for item in items]
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO evidence (ref, body, last_used) VALUES (?, ?, ?) ON CONFLICT(ref) DO UPDATE SET last_used = excluded.last_used",
+                [(ref, json.dumps(item), now) for ref, item in zip(refs, items)],
+            )
+            self._conn.commit()
+            for ref, item in zip(refs, items):
+                self._remember(ref, dict(item, metadata=dict(item.get("metadata") or {})))
+            self._puts += len(items)
+            if self._puts >= PRUNE_EVERY:
+                self._puts = 0
+                self._prune(now)
+        return refs
+
+    def get_many(self, refs: List[str]) -> List[ResearchEvidence]:
+        """Returns the evidence for the refs in order, refs that are no longer stored are skipped."""
+        with self._lock:
+            missing = [ref for ref in dict.fromkeys(refs) if ref not in self._memory]
+            if missing:
+                loaded = {}
+                # chunks, SQLite limits the number of parameters
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    for ref, body in self._conn.execute(f"SELECT ref, body FROM evidence WHERE ref IN ({marks})", chunk):
+                        loaded[ref] = json.loads(body)
+                    self._conn.execute(f"UPDATE evidence SET last_used = ? WHERE ref IN ({marks})", [time.time()] + chunk)
+                self._conn.commit()
+                for ref, item in loaded.items():
+                    self._remember(ref, item)
+                if len(loaded) < len(missing):
+                    logger.warning("%d evidence refs are no longer in the store", len(missing) - len(loaded))
+            # refs served from memory count as used too, or evidence a long chat keeps reading could be pruned
+            self._touch([ref for ref in dict.fromkeys(refs) if ref not in missing])
+            items = []
+            for ref in refs:
+                item = self._memory.get(ref)
+                if item is not None:
+                    items.append(item)
+        # callers may change the metadata of the items (dedupe does), the stored ones stay as they are
+        return [dict(item, metadata=dict(item.get("metadata") or {})) for item in items]
+
+    def touch(self, refs: List[str]) -> None:
+        """Marks the refs as used without loading them, for callers that keep the evidence elsewhere (retrieval indexes)."""
+        with self._lock:
+            self._touch(list(dict.fromkeys(refs)))
+
+    def _touch(self, refs: List[str]) -> None:
+        now = time.time()
+        stale = [ref for ref in refs if now - self._touched.get(ref, 0) >= TOUCH_EVERY]
+        if not stale:
+            return
+        for i in range(0, len(stale), 500):
+            chunk = stale[i:i + 500]
+            self._conn.execute(f"UPDATE evidence SET last_used = ? WHERE ref IN ({','.join('?' * len(chunk))})", [now] + chunk)
+        self._conn.commit()
+        for ref in stale:
+            self._touched[ref] = now
+            self._touched.move_to_end(ref)
+        while len(self._touched) > 2 * self.memory_entries:
+            self._touched.popitem(last=False)
+
+    def pin(self, owner: str, refs: List[str]) -> None:
+        """Keeps the refs from being pruned for as long as the owner holds them, replaces what the owner pinned before."""
+        with self._lock:
+            self._conn.execute("DELETE FROM evidence_pins WHERE owner = ?", (owner,))
+            self._conn.executemany("INSERT OR IGNORE INTO evidence_pins (owner, ref) VALUES (?, ?)", [(owner, ref) for ref in refs])
+            self._conn.commit()
+
+    def unpin(self, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM evidence_pins WHERE owner = ?", (owner,))
+            self._conn.commit()
+
+    def _prune(self, now: float) -> None:
+        self._conn.execute(
+            "DELETE FROM evidence WHERE last_used < ? AND ref NOT IN (SELECT ref FROM evidence_pins)", (now - self.max_age,)
+        )
+        self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT COUNT(*) FROM evidence").fetchone()[0]
+            return {"entries": rows, "memory_entries": len(self._memory)}
+
+
+_evidence_store: Optional[EvidenceStore] = None
+_evidence_store_lock = threading.Lock()
+
+
+def get_evidence_store() -> EvidenceStore:
+    """Returns the shared evidence store."""
+    global _evidence_store
+    with _evidence_store_lock:
+        if _evidence_store is None:
+            _evidence_store = EvidenceStore(os.environ.get("EVIDENCE_STORE_PATH") or db_path("evidence.sqlite"))
+    return _evidence_store
+
+
+def store_evidence(items: List[ResearchEvidence]) -> List[str]:
+    return get_evidence_store().put_many(items) if items else []
+
+
+def load_evidence(refs: Optional[List[str]]) -> List[ResearchEvidence]:
+    return get_evidence_store().get_many(refs) if refs else []
@@ -0,0 +1,256 @@
+import os
+import re
+import codecs
+import threading
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from structured_data import extract_product_data, histogram_rows
+
+# we use browser headers here because some websites block requests without them
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+    'Connection': 'keep-alive',
+}
+
+try:
+    import brotli  # noqa: F401  (urllib3 only decodes br when brotli is installed)
+    HEADERS['Accept-Encoding'] = 'gzip, deflate, br'
+except ImportError:
+    HEADERS['Accept-Encoding'] = 'gzip, deflate'
+
+# Product pages can be several MB, we never read more than this while looking for the title
+MAX_BYTES = int(os.environ.get("FETCH_MAX_BYTES", str(1024 * 1024)))
+CHUNK_SIZE = 16 * 1024
+# Shops whose pages have the star histogram below the average rating, the structured fetch reads on for it
+HISTOGRAM_SHOPS = ("amazon.",)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Returns the shared requests session (keep-alive connection pool per host)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(HEADERS)
+            _session = session
+    return _session
+
+
+class TitleParser(HTMLParser):
+    """Incremental parser that only collects <title> and (optionally) <span id="productTitle">."""
+
+    def __init__(self, want_product_title: bool = False):
+        super().__init__(convert_charrefs=True)
+        self.want_product_title = want_product_title
+        self.title = ""
+        self.product_title = ""
+        self.title_done = False
+        self.product_title_done = False
+        self._in_title = False
+        self._span_depth = 0
+
+    @property
+    def done(self) -> bool:
+        if self.want_product_title:
+            return self.product_title_done
+        return self.title_done
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and not self.title_done:
+            self._in_title = True
+        elif tag == "span":
+            if self._span_depth:
+                self._span_depth += 1
+            elif self.want_product_title and not self.product_title_done and dict(attrs).get("id") == "productTitle":
+                self._span_depth = 1
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._in_title:
+            self._in_title = False
+            self.title_done = True
+        elif tag == "span" and self._span_depth:
+            self._span_depth -= 1
+            if not self._span_depth:
+                self.product_title_done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        if self._span_depth:
+            self.product_title += data
+
+
+class ProductPageParser(TitleParser):
+    """TitleParser that also collects the structured product data of the page.
+
+    That is the JSON-LD scripts, the OpenGraph/product meta tags and the rating labels
+    (aria-label/title attributes and the review count elements Amazon uses for its histogram).
+    """
+
+    RATING_WORDS = ("star", "rating", "review", "out of")
+    # elements whose text is a rating label, by id or data-hook
+    RATING_ELEMENTS = {"acrCustomerReviewText", "total-review-count", "rating-out-of-text"}
+
+    def __init__(self, want_product_title: bool = False, expect_histogram: bool = False):
+        super().__init__(want_product_title)
+        self.expect_histogram = expect_histogram
+        self.json_ld: List[str] = []
+        self.meta: Dict[str, str] = {}
+        self.rating_texts: List[str] = []
+        self.body_done = False
+        self._script: Optional[List[str]] = None
+        self._capture_tag: Optional[str] = None
+        self._capture_depth = 0
+        self._capture: List[str] = []
+        self._extracted_from = None
+        self._product_data = None
+
+    @property
+    def done(self) -> bool:
+        # we keep reading past the title until we have the average and the total (most shops only have
+        # those, in JSON-LD or meta tags), the body ended or the byte cap is hit
+        if not super().done:
+            return False
+        if self.body_done:
+            return True
+        data = self.product_data() or {}
+        if not (data.get("average_rating") and data.get("total_reviews")):
+            return False
+        # the star histogram is waited for on shops known to have one further down (Amazon) and once its
+        # first rows have arrived, a chunk can end in the middle of it
+        rows = histogram_rows(self.rating_texts)
+        if self.expect_histogram or rows:
+            return rows >= 5
+        return True
+
+    def product_data(self) -> Optional[Dict[str, Any]]:
+        # done is checked after every chunk, only extract again when something new was collected
+        seen = (len(self.json_ld), len(self.meta), len(self.rating_texts))
+        if seen != self._extracted_from:
+            self._extracted_from = seen
+            self._product_data = extract_product_data(self.json_ld, self.meta, self.rating_texts)
+        return self._product_data
+
+    def handle_starttag(self, tag, attrs):
+        super().handle_starttag(tag, attrs)
+        attrs = dict(attrs)
+        if tag == "script" and (attrs.get("type") or "").lower() == "application/ld+json":
+            self._script = []
+        elif tag == "meta":
+            key = (attrs.get("property") or attrs.get("name") or "").lower()
+            if key.startswith(("og:", "product:")) and attrs.get("content"):
+                self.meta.setdefault(key, attrs["content"])
+        for name in ("aria-label", "title"):
+            label = attrs.get(name)
+            if label and any(word in label.lower() for word in self.RATING_WORDS):
+                self.rating_texts.append(label)
+        if self._capture_tag == tag:
+            self._capture_depth += 1
+        elif self._capture_tag is None and (attrs.get("id") in self.RATING_ELEMENTS or attrs.get("data-hook") in self.RATING_ELEMENTS):
+            self._capture_tag, self._capture_depth, self._capture = tag, 1, []
+
+    def handle_endtag(self, tag):
+        super().handle_endtag(tag)
+        if tag == "script" and self._script is not None:
+            self.json_ld.append("".join(self._script))
+            self._script = None
+        elif tag == "body":
+            self.body_done = True
+        if tag == self._capture_tag:
+            self._capture_depth -= 1
+            if not self._capture_depth:
+                self.rating_texts.append("".join(self._capture))
+                self._capture_tag = None
+
+    def handle_data(self, data):
+        super().handle_data(data)
+        if self._script is not None:
+            self._script.append(data)
+        if self._capture_tag is not None:
+            self._capture.append(data)
+
+
+@dataclass
+class FetchResult:
+    status_code: int
+    title: str
+    bytes_read: int
+    complete: bool  # True if we read the whole body
+    product_data: Optional[Dict[str, Any]] = None  # see structured_data.py, only when asked for
+
+
+META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.I)
+
+
+def page_encoding(content_type: str, head: bytes) -> str:
+    """The charset the server sent, else the one the page declares in <meta charset>, else utf-8.
+
+    requests reports ISO-8859-1 for text/html without a charset, which garbles UTF-8 pages,
+    so we only trust the header when the charset is actually in it.
+    """
+    candidates = []
+    found = re.search(r"charset\s*=\s*[\"']?([\w.:-]+)", content_type or "", re.I)
+    if found:
+        candidates.append(found.group(1))
+    if head.startswith(codecs.BOM_UTF8):
+        candidates.append("utf-8-sig")
+    found = META_CHARSET.search(head[:4096])
+    if found:
+        candidates.append(found.group(1).decode("ascii"))
+    for name in candidates:
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            continue
+    return "utf-8"
+
+
+def fetch_title(url: str, want_product_title: bool = False, structured: bool = False, max_bytes: int = MAX_BYTES, timeout: float = 10) -> FetchResult:
+    """Streams the page and stops as soon as the title (or the byte cap) has arrived.
+
+    With structured=True we also collect the product data (rating, histogram, price) and read on
+    until it is complete, the body ends or the byte cap is hit.
+    """
+    if structured:
+        parser = ProductPageParser(want_product_title, expect_histogram=any(shop in url for shop in HISTOGRAM_SHOPS))
+    else:
+        parser = TitleParser(want_product_title)
+    bytes_read = 0
+    complete = True
+
+    with get_session().get(url, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            return FetchResult(response.status_code, "", 0, False)
+
+        decoder = None
+        # iter_content hands us already decompressed bytes
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if decoder is None:
+                encoding = page_encoding(response.headers.get("Content-Type", ""), chunk)
+                decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            bytes_read += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done or bytes_read >= max_bytes:
+                complete = False
+                break
+        # leaving the with block closes the response, the connection goes back to the pool
+        # if it was read fully, otherwise it is dropped instead of draining megabytes we do not need
+
+    title = parser.product_title.strip() if parser.product_title_done else ""
+    if not title:
+        title = parser.title.strip()
+    product_data = parser.product_data() if structured else None
+    return FetchResult(response.status_code, " ".join(title.split()), bytes_read, complete, product_data)
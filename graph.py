@@ -1,23 +1,43 @@
+import os
+import asyncio
+import logging
+import threading
+
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END, START
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.prebuilt import ToolNode
-from langchain_community.tools.tavily_search import TavilySearchResults
+from langgraph.types import Send
+from langchain_core.runnables import RunnableLambda
 
-from state import AgentState
+from state import AgentState, ComparisonState
+from checkpointer import get_checkpointer
+from metrics import instrument_node, registry, start_exporters
+from search_cache import get_search_cache
+from report_cache import get_report_cache
+from evidence_store import get_evidence_store
+from catalog import get_catalog
+from url_canonical import canonicalize_url
 from nodes import (
     parse_link, fallback_title_extractor,
     researcher_amazon, researcher_reddit, researcher_web,
-    harvest_reviews, generate_report, chat_node, summarize_conversation
+    aresearcher_amazon, aresearcher_reddit, aresearcher_web,
+    dedupe_evidence, pack_evidence, harvest_reviews, generate_report, chat_node, summarize_conversation,
+    chat_tools, generate_comparison, merge_refresh, report_message,
 )
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 # Research Subgraph
+# Each researcher has a sync and an async version, app.invoke/app.stream use the sync one
+# and app.ainvoke/app.astream use the async one so the three searches share the event loop.
+# Every node is wrapped with instrument_node so its wall time shows up in the metrics (see metrics.py).
 research_builder = StateGraph(AgentState)
-research_builder.add_node("researcher_amazon", researcher_amazon)
-research_builder.add_node("researcher_reddit", researcher_reddit)
-research_builder.add_node("researcher_web", researcher_web)
+research_builder.add_node("researcher_amazon", RunnableLambda(
+    instrument_node("researcher_amazon", researcher_amazon), afunc=instrument_node("researcher_amazon", aresearcher_amazon)))
+research_builder.add_node("researcher_reddit", RunnableLambda(
+    instrument_node("researcher_reddit", researcher_reddit), afunc=instrument_node("researcher_reddit", aresearcher_reddit)))
+research_builder.add_node("researcher_web", RunnableLambda(
+    instrument_node("researcher_web", researcher_web), afunc=instrument_node("researcher_web", aresearcher_web)))
 
 research_builder.add_edge(START, "researcher_amazon")
 research_builder.add_edge(START, "researcher_reddit")
@@ -49,24 +69,43 @@ def route_chat(state: AgentState):
     if hasattr(last_message, "tool_calls") and len(last_message.tool_calls) > 0:
         return "tools"
 
-    if len(messages) > 5:
-        return "summarize"
-
+    # summarizing happens in the background after the answer (see summarizer.py)
     return "end"
 
+def add_product_research(builder: StateGraph) -> None:
+    """Adds the per-product part of the flow, parse_link through harvest_reviews, to a graph.
+
+    The main graph continues with generate_report, comparison mode runs it once per product.
+    """
+    builder.add_node("parse_link", instrument_node("parse_link", parse_link))
+    builder.add_node("fallback_title_extractor", instrument_node("fallback_title_extractor", fallback_title_extractor))
+    builder.add_node("research_subgraph", research_subgraph)
+    builder.add_node("dedupe_evidence", instrument_node("dedupe_evidence", dedupe_evidence))
+    builder.add_node("pack_evidence", instrument_node("pack_evidence", pack_evidence))
+    builder.add_node("harvest_reviews", instrument_node("harvest_reviews", harvest_reviews))
+
+    builder.add_conditional_edges(
+        "parse_link",
+        check_parser_success,
+        {"success": "research_subgraph", "fail": "fallback_title_extractor"}
+    )
+
+    builder.add_edge("fallback_title_extractor", "research_subgraph")
+    builder.add_edge("research_subgraph", "dedupe_evidence")
+    builder.add_edge("dedupe_evidence", "pack_evidence")
+    builder.add_edge("pack_evidence", "harvest_reviews")
+
 # Main Graph
 workflow = StateGraph(AgentState)
 
-workflow.add_node("parse_link", parse_link)
-workflow.add_node("fallback_title_extractor", fallback_title_extractor)
-workflow.add_node("research_subgraph", research_subgraph)
-workflow.add_node("harvest_reviews", harvest_reviews)
-workflow.add_node("generate_report", generate_report)
-workflow.add_node("chat_node", chat_node)
-workflow.add_node("summarize_conversation", summarize_conversation)
+add_product_research(workflow)
+workflow.add_node("generate_report", instrument_node("generate_report", generate_report))
+workflow.add_node("chat_node", instrument_node("chat_node", chat_node))
+# Not routed to from chat_node, summarizer.py applies its updates to idle threads as this node
+workflow.add_node("summarize_conversation", instrument_node("summarize_conversation", summarize_conversation))
 
-tools = [TavilySearchResults(max_results=3)]
-workflow.add_node("tools", ToolNode(tools))
+# runs chat_node's searches, answering repeats and questions the evidence covers without Tavily
+workflow.add_node("tools", instrument_node("tools", chat_tools))
 
 workflow.add_conditional_edges(
     START,
@@ -74,26 +113,176 @@ workflow.add_conditional_edges(
     {"chat_node": "chat_node", "parse_link": "parse_link"}
 )
 
-workflow.add_conditional_edges(
-    "parse_link",
-    check_parser_success,
-    {"success": "research_subgraph", "fail": "fallback_title_extractor"}
-)
-
-workflow.add_edge("fallback_title_extractor", "research_subgraph")
-workflow.add_edge("research_subgraph", "harvest_reviews")
 workflow.add_edge("harvest_reviews", "generate_report")
-workflow.add_edge("generate_report", "chat_node")
+# the thread is idle once the report is written, the first question starts at chat_node (route_start)
+workflow.add_edge("generate_report", END)
 
 workflow.add_conditional_edges(
     "chat_node",
     route_chat,
-    {"tools": "tools", "summarize": "summarize_conversation", "end": END}
+    {"tools": "tools", "end": END}
 )
 
 workflow.add_edge("tools", "chat_node")
 workflow.add_edge("summarize_conversation", END)
 
-memory = MemorySaver()
+# research_subgraph is left unwrapped so it keeps running (and streaming) as a real subgraph,
+# its three researchers are instrumented above.
+
+# Checkpoints go to SQLite so chats survive a restart, old checkpoints and idle threads are pruned (see checkpointer.py)
+memory = get_checkpointer()
 app = workflow.compile(checkpointer=memory)
 
+registry.gauge("search_cache", lambda: get_search_cache().stats() if get_search_cache() else {})
+registry.gauge("evidence_store", lambda: get_evidence_store().stats())
+registry.gauge("catalog", lambda: get_catalog().stats())
+start_exporters()
+
+
+
+def seed_thread(config, values):
+    """Writes an already finished report into a chat thread so follow-up questions work without running the research again."""
+    app.update_state(
+        config,
+        {
+            "product_link": values.get("product_link"),
+            "product_query": values.get("product_query"),
+            "reviews_analysis": values.get("reviews_analysis"),
+            "final_report": values["final_report"],
+            "unique_evidence": values.get("unique_evidence"),
+            "messages": [report_message(values["final_report"])],
+            "summary": "",
+        },
+        # as if chat_node had just answered, so the thread is idle and the next message goes to chat_node
+        as_node="chat_node",
+    )
+
+
+# Comparison mode: the research of every product runs as its own branch (Send API) and one comparison
+# report is written at the end. Searches, the Tavily clients and the caches are process wide, so the
+# branches share them like separate runs do.
+COMPARE_MAX_PRODUCTS = int(os.environ.get("COMPARE_MAX_PRODUCTS", "6"))
+# products researched at the same time, across all comparisons running in this process
+COMPARE_CONCURRENCY = int(os.environ.get("COMPARE_CONCURRENCY", "3"))
+_product_slots = threading.BoundedSemaphore(COMPARE_CONCURRENCY)
+
+product_builder = StateGraph(AgentState)
+add_product_research(product_builder)
+product_builder.add_edge(START, "parse_link")
+product_builder.add_edge("harvest_reviews", END)
+product_pipeline = product_builder.compile()
+
+
+def _cached_product(url):
+    """Uses a fresh report of the product from the report cache instead of researching it again."""
+    cached = get_report_cache().get(canonicalize_url(url).key)
+    if not cached:
+        return None
+    return {
+        "product_link": url,
+        "product_query": cached["product_query"],
+        "reviews_analysis": cached["reviews_analysis"],
+        "unique_evidence": cached["unique_evidence"],
+        "final_report": cached["final_report"],
+        "error": None,
+    }
+
+
+def _product_result(url, values=None, error=None):
+    values = values or {}
+    return {
+        "product_link": url,
+        "product_query": values.get("product_query"),
+        "reviews_analysis": values.get("reviews_analysis"),
+        "unique_evidence": values.get("unique_evidence") or values.get("research_evidence") or [],
+        "final_report": None,
+        "error": error,
+    }
+
+
+def research_compared_product(state, config):
+    """Researches one product of a comparison, a failing product is reported instead of failing the comparison."""
+    url = state["product_link"]
+    cached = _cached_product(url)
+    if cached:
+        return {"products": [cached]}
+    with _product_slots:
+        try:
+            values = product_pipeline.invoke(state, config)
+        except Exception as e:
+            logger.exception("Researching %s for a comparison failed", url)
+            return {"products": [_product_result(url, error=str(e))]}
+    return {"products": [_product_result(url, values)]}
+
+
+async def _aacquire_slot():
+    """Waits for a product slot in a worker thread, the slots are shared with the sync comparisons."""
+    acquiring = asyncio.ensure_future(asyncio.to_thread(_product_slots.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # the worker thread still gets the slot after we are cancelled, hand it back when it does
+        acquiring.add_done_callback(lambda f: _product_slots.release() if not f.cancelled() and f.exception() is None else None)
+        raise
+
+
+async def aresearch_compared_product(state, config):
+    url = state["product_link"]
+    cached = _cached_product(url)
+    if cached:
+        return {"products": [cached]}
+    await _aacquire_slot()
+    try:
+        values = await product_pipeline.ainvoke(state, config)
+    except Exception as e:
+        logger.exception("Researching %s for a comparison failed", url)
+        return {"products": [_product_result(url, error=str(e))]}
+    finally:
+        _product_slots.release()
+    return {"products": [_product_result(url, values)]}
+
+
+def fan_out_products(state: ComparisonState):
+    return [
+        Send("research_product", {"product_link": url, "research_evidence": [], "messages": [], "summary": ""})
+        for url in state["product_links"]
+    ]
+
+
+comparison_builder = StateGraph(ComparisonState)
+comparison_builder.add_node("research_product", RunnableLambda(research_compared_product, afunc=aresearch_compared_product))
+comparison_builder.add_node("generate_comparison", instrument_node("generate_comparison", generate_comparison))
+comparison_builder.add_conditional_edges(START, fan_out_products, ["research_product"])
+comparison_builder.add_edge("research_product", "generate_comparison")
+comparison_builder.add_edge("generate_comparison", END)
+
+# No checkpointer, the finished comparison is written into a chat thread with seed_thread like a cached report
+compare_app = comparison_builder.compile()
+
+
+# Refresh mode: starts from the stored evidence and report of a product (see service.refresh_product),
+# searches only for results published since the last run and writes a new report only if they are material
+def check_refresh_material(state: AgentState):
+    return "regenerate" if state["refresh"]["material"] else "keep"
+
+
+refresh_builder = StateGraph(AgentState)
+refresh_builder.add_node("research_subgraph", research_subgraph)
+refresh_builder.add_node("merge_refresh", instrument_node("merge_refresh", merge_refresh))
+refresh_builder.add_node("pack_evidence", instrument_node("pack_evidence", pack_evidence))
+refresh_builder.add_node("harvest_reviews", instrument_node("harvest_reviews", harvest_reviews))
+refresh_builder.add_node("generate_report", instrument_node("generate_report", generate_report))
+
+refresh_builder.add_edge(START, "research_subgraph")
+refresh_builder.add_edge("research_subgraph", "merge_refresh")
+refresh_builder.add_conditional_edges(
+    "merge_refresh",
+    check_refresh_material,
+    {"regenerate": "pack_evidence", "keep": END}
+)
+refresh_builder.add_edge("pack_evidence", "harvest_reviews")
+refresh_builder.add_edge("harvest_reviews", "generate_report")
+refresh_builder.add_edge("generate_report", END)
+
+# No checkpointer, like compare_app the result is seeded into the caller's chat thread
+refresh_app = refresh_builder.compile()
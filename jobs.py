@@ -0,0 +1,125 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from service import stream_research
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Research runs at the same time on this server (all sessions together), the rest wait in the queue
+JOBS_MAX_RUNNING = int(os.environ.get("JOBS_MAX_RUNNING", "2"))
+JOBS_MAX_QUEUED = int(os.environ.get("JOBS_MAX_QUEUED", "20"))
+# Finished jobs are kept this long so a session that reconnects still finds its result
+JOBS_KEEP_SECONDS = float(os.environ.get("JOBS_KEEP_SECONDS", str(60 * 60)))
+
+
+class QueueFull(Exception):
+    """Raised when too many research jobs are waiting already."""
+
+
+@dataclass
+class Job:
+    id: str
+    url: str
+    config: Dict[str, Any]
+    status: str = "queued"  # queued, running, done, failed
+    progress: List[str] = field(default_factory=list)  # labels of the finished steps
+    report: str = ""  # the report as far as it has been written
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+class JobManager:
+    """Runs research jobs in a thread pool outside the Streamlit script, shared by every session of the server."""
+
+    def __init__(self, max_running: int = JOBS_MAX_RUNNING, max_queued: int = JOBS_MAX_QUEUED, keep_seconds: float = JOBS_KEEP_SECONDS):
+        self.max_queued = max_queued
+        self.keep_seconds = keep_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix="research-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url: str, config: Dict[str, Any]) -> str:
+        """Queues a research run for the url on the thread in config and returns the job id."""
+        with self._lock:
+            self._expire()
+            if sum(1 for job in self._jobs.values() if job.status == "queued") >= self.max_queued:
+                raise QueueFull("Too many reports are being generated right now, please try again in a minute")
+            job = Job(id=uuid.uuid4().hex, url=url, config=config)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        registry.inc("jobs_submitted")
+        return job.id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_position(self, job_id: str) -> int:
+        """1 for the next job to start, 0 if the job is not waiting."""
+        with self._lock:
+            queued = sorted((j for j in self._jobs.values() if j.status == "queued"), key=lambda j: j.created_at)
+        for position, job in enumerate(queued, 1):
+            if job.id == job_id:
+                return position
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        registry.observe("job_queue_seconds", job.started_at - job.created_at)
+        try:
+            for event in stream_research(job.url, job.config):
+                if event["type"] == "progress":
+                    job.progress.append(event["label"])
+                elif event["type"] == "token":
+                    job.report += event["text"]
+                elif event["type"] == "done":
+                    job.result = event["result"]
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Research job %s for %s failed", job.id, job.url)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            registry.observe("job_seconds", job.finished_at - job.started_at, status=job.status)
+
+    def _expire(self) -> None:
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished_at > self.keep_seconds]:
+            del self._jobs[job_id]
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Returns the job manager of this process (Streamlit reruns the script, but imported modules stay loaded)."""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+            registry.gauge("jobs", _job_manager.stats)
+    return _job_manager
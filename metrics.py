@@ -0,0 +1,308 @@
+"""Local metrics for the graph: node latency, LLM tokens, Tavily calls, fetched bytes and checkpoint sizes.
+
+Nothing is sent anywhere. Set METRICS_PORT to serve them in the Prometheus text format on
+http://localhost:<port>/metrics (and as JSON on /metrics.json), and/or METRICS_JSON_PATH to
+dump them to a JSON file every METRICS_DUMP_INTERVAL seconds.
+"""
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+QUANTILES = (0.5, 0.95, 0.99)
+# how many recent observations per series are kept to compute the quantiles
+RESERVOIR_SIZE = 2048
+
+# the node that is running in this thread / task, used to attribute LLM and Tavily calls
+current_node = contextvars.ContextVar("current_node", default="")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Thread safe store of counters and summaries (recent samples + running sum/count)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._summaries: Dict[str, Dict[LabelKey, Dict[str, Any]]] = {}
+        self._gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self._help: Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._summaries.setdefault(name, {})
+            summary = series.get(key)
+            if summary is None:
+                summary = series[key] = {"samples": deque(maxlen=RESERVOIR_SIZE), "sum": 0.0, "count": 0}
+            summary["samples"].append(value)
+            summary["sum"] += value
+            summary["count"] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name: str, callback: Callable[[], Dict[str, float]], help_text: str = "") -> None:
+        """Registers a callback whose {suffix: value} result is exported as name_suffix gauges."""
+        self._gauges[name] = callback
+        if help_text:
+            self._help[name] = help_text
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns every metric as plain data (quantiles are computed here)."""
+        with self._lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                for name, series in self._counters.items()
+            }
+            summaries = {}
+            for name, series in self._summaries.items():
+                summaries[name] = []
+                for key, summary in series.items():
+                    samples = sorted(summary["samples"])
+                    summaries[name].append({
+                        "labels": dict(key),
+                        "count": summary["count"],
+                        "sum": summary["sum"],
+                        "quantiles": {str(q): _quantile(samples, q) for q in QUANTILES},
+                    })
+        gauges = {}
+        for name, callback in list(self._gauges.items()):
+            try:
+                gauges[name] = callback()
+            except Exception as e:
+                gauges[name] = {"error": str(e)}
+        return {"timestamp": time.time(), "counters": counters, "summaries": summaries, "gauges": gauges}
+
+    def render_prometheus(self) -> str:
+        """Renders the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, series in sorted(snapshot["counters"].items()):
+            metric = f"{name}_total"
+            if name in self._help:
+                lines.append(f"# HELP {metric} {self._help[name]}")
+            lines.append(f"# TYPE {metric} counter")
+            for item in series:
+                lines.append(f"{metric}{_labels(item['labels'])} {item['value']}")
+        for name, series in sorted(snapshot["summaries"].items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for item in series:
+                for q, value in item["quantiles"].items():
+                    lines.append(f"{name}{_labels(dict(item['labels'], quantile=q))} {value}")
+                lines.append(f"{name}_sum{_labels(item['labels'])} {item['sum']}")
+                lines.append(f"{name}_count{_labels(item['labels'])} {item['count']}")
+        for name, values in sorted(snapshot["gauges"].items()):
+            for suffix, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {name}_{suffix} gauge")
+                    lines.append(f"{name}_{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+    return samples[index]
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v)}"'.replace("\n", " ") for k, v in sorted(labels.items()))
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+registry.describe("node_seconds", "Wall time of graph nodes")
+registry.describe("llm_seconds", "Latency of LLM calls")
+registry.describe("llm_tokens", "LLM tokens by node and kind (prompt/completion)")
+registry.describe("tavily_seconds", "Latency of Tavily searches")
+registry.describe("tavily_calls", "Tavily searches by source")
+registry.describe("fetch_bytes", "Bytes read by parse_link")
+registry.describe("checkpoint_bytes", "Size of written checkpoints")
+registry.describe("checkpoint_write_seconds", "Time to write a checkpoint")
+
+
+def instrument_node(name: str, func: Callable) -> Callable:
+    """Wraps a (sync or async) node function to record its wall time and mark it as the current node."""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            token = current_node.set(name)
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await func(*args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                registry.observe("node_seconds", time.perf_counter() - start, node=name, status=status)
+                current_node.reset(token)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = current_node.set(name)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            registry.observe("node_seconds", time.perf_counter() - start, node=name, status=status)
+            current_node.reset(token)
+    return wrapper
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Records latency and prompt/completion tokens of every LLM call, per graph node."""
+
+    def __init__(self):
+        self._runs: Dict[UUID, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, metadata: Optional[Dict[str, Any]]) -> None:
+        node = (metadata or {}).get("langgraph_node") or current_node.get() or "none"
+        with self._lock:
+            self._runs[run_id] = (time.perf_counter(), node)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata=None, **kwargs) -> None:
+        self._start(run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata=None, **kwargs) -> None:
+        self._start(run_id, metadata)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        with self._lock:
+            started, node = self._runs.pop(run_id, (None, "none"))
+        if started is not None:
+            registry.observe("llm_seconds", time.perf_counter() - started, node=node)
+
+        prompt_tokens = completion_tokens = 0
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            # streamed responses carry the usage on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    message_usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt_tokens += message_usage.get("input_tokens", 0)
+                    completion_tokens += message_usage.get("output_tokens", 0)
+        if prompt_tokens:
+            registry.inc("llm_tokens", prompt_tokens, node=node, kind="prompt")
+        if completion_tokens:
+            registry.inc("llm_tokens", completion_tokens, node=node, kind="completion")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        with self._lock:
+            started, node = self._runs.pop(run_id, (None, "none"))
+        registry.inc("llm_errors", node=node, error=type(error).__name__)
+
+
+llm_callback = LLMMetricsCallback()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(registry.snapshot()).encode()
+            content_type = "application/json"
+        elif self.path.startswith("/metrics"):
+            body = registry.render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves /metrics (Prometheus text) and /metrics.json from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def start_json_dump(path: str, interval: float = 60) -> threading.Thread:
+    """Writes the snapshot to path every interval seconds from a daemon thread."""
+    def dump_forever():
+        while True:
+            time.sleep(interval)
+            dump_json(path)
+
+    thread = threading.Thread(target=dump_forever, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
+
+
+def dump_json(path: str) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry.snapshot(), f, indent=2)
+    os.replace(tmp, path)
+
+
+_exporters_started = False
+
+
+def start_exporters() -> None:
+    """Starts the exporters configured through METRICS_PORT / METRICS_JSON_PATH (only once per process)."""
+    global _exporters_started
+    if _exporters_started:
+        return
+    _exporters_started = True
+    port = os.environ.get("METRICS_PORT")
+    if port:
+        try:
+            start_http_server(int(port))
+        except OSError as e:
+            # another process (e.g. a second Streamlit worker) already serves this port
+            print(f"Metrics endpoint not started on port {port}: {e}")
+    path = os.environ.get("METRICS_JSON_PATH")
+    if path:
+        start_json_dump(path, float(os.environ.get("METRICS_DUMP_INTERVAL", "60")))
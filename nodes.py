@@ -1,15 +1,32 @@
 import os
+import time
+import asyncio
+import itertools
+import weakref
 import requests
-from bs4 import BeautifulSoup
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import SystemMessage, HumanMessage, RemoveMessage, ToolMessage, AIMessage
-from tavily import TavilyClient
+from tavily import TavilyClient, AsyncTavilyClient
 from langchain_community.tools.tavily_search import TavilySearchResults
 import json
-
-from state import AgentState, ResearchEvidence, SentimentAnalysis
+from langsmith import traceable
+
+from state import AgentState, ResearchEvidence, SentimentAnalysis, ComparisonState
+from search_cache import get_search_cache, normalize_query
+from fetcher import fetch_title
+from title_normalizer import normalize_title, get_title_memo
+from url_canonical import canonicalize_url
+from catalog import get_catalog
+from evidence import relevance, pack_evidence_text, dedupe_evidence as dedupe_evidence_list, chunk_evidence, count_tokens, EVIDENCE_TOKEN_BUDGET
+from sentiment import merge_sentiment, apply_known_ratings
+from structured_data import known_ratings
+from evidence_store import store_evidence, load_evidence
+from retrieval import get_index, split_report, format_passages, answer_from_evidence
+from metrics import registry, llm_callback
+import ratelimit
 
 def clean_json(text: str) -> str:
     """Cleans markdown code blocks from JSON string. which I dont understand"""
@@ -22,87 +39,220 @@ def clean_json(text: str) -> str:
         text = text[:-3]
     return text.strip()
 
+def clean_markdown(report: str) -> str:
+    """Removes the markdown code block the LLM sometimes wraps a report in."""
+    report = report.strip()
+    if report.startswith("```markdown"):
+        report = report[11:]
+    elif report.startswith("```"):
+        report = report[3:]
+    if report.endswith("```"):
+        report = report[:-3]
+    return report.strip()
+
+# "single" sends the packed evidence in one call, "mapreduce" analyzes every chunk of the evidence in parallel
+# and merges the results, "auto" uses map-reduce only when the evidence does not fit in the packed block.
+HARVEST_MODE = os.environ.get("HARVEST_MODE", "auto")
+MAP_CONCURRENCY = int(os.environ.get("HARVEST_MAP_CONCURRENCY", "6"))
+
+# Output tokens we reserve per call in the OpenAI token budget, the real count is only known afterwards
+LLM_OUTPUT_TOKEN_ESTIMATE = int(os.environ.get("LLM_OUTPUT_TOKEN_ESTIMATE", "600"))
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """ChatOpenAI whose calls wait for the shared OpenAI budget and are retried on 429s and transient errors (see ratelimit.py)."""
+
+    def _estimate_tokens(self, messages) -> int:
+        return sum(count_tokens(m.content if isinstance(m.content, str) else json.dumps(m.content)) for m in messages) + LLM_OUTPUT_TOKEN_ESTIMATE
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ratelimit.call("openai", lambda: super(ScheduledChatOpenAI, self)._generate(messages, stop, run_manager, **kwargs),
+                              tokens=self._estimate_tokens(messages))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await ratelimit.acall("openai", lambda: super(ScheduledChatOpenAI, self)._agenerate(messages, stop, run_manager, **kwargs),
+                                     tokens=self._estimate_tokens(messages))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        scheduler = ratelimit.get_scheduler("openai")
+        for attempt in itertools.count():
+            scheduler.acquire(self._estimate_tokens(messages))
+            started = False
+            try:
+                for chunk in super()._stream(messages, stop, run_manager, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                # once tokens went out to the caller we cannot take them back
+                delay = None if started else ratelimit.should_retry("openai", e, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        scheduler = ratelimit.get_scheduler("openai")
+        for attempt in itertools.count():
+            await scheduler.aacquire(self._estimate_tokens(messages))
+            started = False
+            try:
+                async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                delay = None if started else ratelimit.should_retry("openai", e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
 def get_llm():
     """Returns the LLM instance."""
     api_key = os.environ.get("OPENAI_API_KEY")
-    return ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key)
+    # the metrics callback records latency and token usage of every call (stream_usage so streamed calls report tokens too),
+    # retries are done by the scheduler so they respect the shared budget
+    return ScheduledChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key, callbacks=[llm_callback],
+                               stream_usage=True, max_retries=0)
+
+
+_tavily_client = None
+
+# The async client keeps one httpx connection pool, and that pool belongs to the event loop that created it,
+# so we keep one shared client per running loop instead of one per call.
+_async_tavily_clients = weakref.WeakKeyDictionary()
 
 
 def get_tavily():
-    """Returns the Tavily client."""
-    api_key = os.environ.get("TAVILY_API_KEY")
-    return TavilyClient(api_key=api_key)
+    """Returns the shared Tavily client."""
+    global _tavily_client
+    if _tavily_client is None:
+        api_key = os.environ.get("TAVILY_API_KEY")
+        _tavily_client = TavilyClient(api_key=api_key)
+    return _tavily_client
+
+
+def get_async_tavily():
+    """Returns the shared async Tavily client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_tavily_clients.get(loop)
+    if client is None:
+        api_key = os.environ.get("TAVILY_API_KEY")
+        client = AsyncTavilyClient(api_key=api_key)
+        _async_tavily_clients[loop] = client
+    return client
+
+
+async def close_async_tavily():
+    """Closes the async Tavily client of the running event loop (call this before the loop shuts down)."""
+    client = _async_tavily_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
 
 @traceable
 def parse_link(state: AgentState) -> Dict[str, Any]:
-    """Extracts product name/metadata from the link using BeautifulSoup + LLM."""
+    """Extracts product name/metadata from the link using the streaming fetcher, title rules and (if needed) the LLM."""
     # gets the url from the state
     link = state["product_link"]
 
-    # we used headers here because some websites block requests without them
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept-Language': 'en-US,en;q=0.9'
-    }
-    response = requests.get(link, headers=headers, timeout=10)
+    # Products we have seen before (or that came with a catalog feed) need neither the page nor the LLM
+    product = canonicalize_url(link)
+    catalog = get_catalog()
+    product_name = catalog.lookup(product)
+    if product_name:
+        registry.inc("catalog_lookups", node="parse_link", result="hit")
+        print(f"Identified Product: {product_name}")
+        return {"product_query": product_name, "product_data": catalog.product_data(product)}
+    registry.inc("catalog_lookups", node="parse_link", result="miss")
+
+    # We stream the page through the shared session and stop reading once the <title> (or the Amazon
+    # productTitle span) and the structured product data (rating, star histogram, price) have arrived.
+    try:
+        page = fetch_title(link, want_product_title="amazon" in link, structured=True)
+    except requests.RequestException as e:
+        print(f"Error fetching product page: {e}")
+        return {"product_query": None, "product_data": None}
 
-    # we check if we were able to download the HTML of the product page (Status 200 = Success)
-    if response.status_code != 200:
-        return {"product_query": None}
+    registry.observe("fetch_bytes", page.bytes_read)
 
-    # We use BeautifulSoup to parse the HTML and extract the <title> of the product from it
-    soup = BeautifulSoup(response.content, 'html.parser')
-    title = soup.title.string if soup.title else ""
+    # we check if we were able to download the HTML of the product page (Status 200 = Success)
+    if page.status_code != 200:
+        return {"product_query": None, "product_data": None}
 
-    # Specific logic for Amazon to get cleaner titles
-    if "amazon" in link:
-        product_title_elem = soup.find("span", {"id": "productTitle"})
-        if product_title_elem:
-            title = product_title_elem.get_text().strip()
+    title = page.title
+    product_data = page.product_data
+    registry.inc("product_data_extracted", found=",".join(sorted(known_ratings(product_data))) or "none")
 
     if not title:
-        return {"product_query": None}
-
-    # The title often has extra stuff so here we use LLM to extract just the title.
-    llm = get_llm()
-    if llm:
-        prompt = ChatPromptTemplate.from_template(
-            "Extract the precise product name from this webpage title. Return ONLY the product name, no extra text.\nTitle: {title}"
-        )
-        chain = prompt | llm
-        product_name = chain.invoke({"title": title}).content.strip()
+        return {"product_query": None, "product_data": None}
+
+    # Repeated products never hit the model, we remember every title we have already cleaned up
+    memo = get_title_memo()
+    product_name = memo.get(title)
+    if product_name:
+        catalog.put(product, product_name, "title_memo", product_data)
+        print(f"Identified Product: {product_name}")
+        return {"product_query": product_name, "product_data": product_data}
+
+    # The title often has extra stuff ("Amazon.com: ... : Electronics"), the per-shop rules strip it
+    # and we only fall back to the LLM when the rules are not confident about the result.
+    normalized = normalize_title(title, link)
+    if normalized.blocked:
+        return {"product_query": None, "product_data": None}
+
+    if normalized.confident:
+        product_name = normalized.name
     else:
-        product_name = title[:100]
+        llm = get_llm()
+        if llm:
+            prompt = ChatPromptTemplate.from_template(
+                "Extract the precise product name from this webpage title. Return ONLY the product name, no extra text.\nTitle: {title}"
+            )
+            chain = prompt | llm
+            product_name = chain.invoke({"title": title}).content.strip()
+        else:
+            product_name = title[:100]
+
+    if product_name:
+        memo.put(title, product_name, normalized.rule if normalized.confident else "llm")
+        catalog.put(product, product_name, "parse_link", product_data)
 
     print(f"Identified Product: {product_name}")
-    return {"product_query": product_name}
+    return {"product_query": product_name, "product_data": product_data}
 
 @traceable
 def fallback_title_extractor(state: AgentState) -> Dict[str, Any]:
     """This node is a backup plan if parse_link() fails to extract the product name. It tries to guess the product name from the URL structure itself."""
     link = state["product_link"]
 
-    # Extracts the Amazon ASIN (product ID) an does some crazy string parsing to get the product name which I don't understand.
-    if "amazon" in link and "/dp/" in link:
-        parts = link.split("/dp/")
-        if len(parts) > 1:
-            guess = parts[1].split("/")[0].split("?")[0]
-            return {"product_query": f"Amazon Product {guess}"}
+    # The catalog knows the name if we resolved this product before or it was in a loaded feed,
+    # that beats "Amazon Product B0..." which no search engine does anything useful with.
+    product = canonicalize_url(link)
+    catalog = get_catalog()
+    product_name = catalog.lookup(product)
+    if product_name:
+        registry.inc("catalog_lookups", node="fallback", result="hit")
+        return {"product_query": product_name}
+
+    # Extracts the Amazon ASIN (product ID), the canonicalizer also understands /gp/product/ and friends.
+    if product.retailer == "amazon" and product.product_id:
+        registry.inc("catalog_lookups", node="fallback", result="miss")
+        return {"product_query": f"Amazon Product {product.product_id}"}
 
     guess = link.split("/")[-1].replace("-", " ").replace("_", " ").split("?")[0]
     if not guess:
         guess = "Product from URL"
+    else:
+        # slugs are often a shortened product name, a catalog product they clearly name is the better query
+        match = catalog.match(guess)
+        if match:
+            registry.inc("catalog_lookups", node="fallback", result="search")
+            return {"product_query": match["name"]}
+    registry.inc("catalog_lookups", node="fallback", result="miss")
     return {"product_query": guess}
 
 # Research Subgraph Nodes
 
-# This is the core search function used by all three researchers (Amazon, Reddit, Web). It uses the Tavily API to find relevant information about the product.
-@traceable
-def perform_search(query: str, source_type: str) -> List[ResearchEvidence]:
-    """Performs search and returns list of ResearchEvidence."""
-
-    tavily = get_tavily()
-
+def build_search_query(query: str, source_type: str) -> str:
+    """Adds the source specific keywords to the product query."""
     search_query = query
     if source_type == "amazon":
         # Targets verified feedback, specs, and direct comparisons
@@ -116,55 +266,283 @@ def perform_search(query: str, source_type: str) -> List[ResearchEvidence]:
         # Targets expert analysis, benchmarks, and deep-dives
         search_query += " 'in-depth review' benchmarks 'hands-on' alternatives 'vs' blog transcript"
 
-    results = tavily.search(query=search_query, search_depth="advanced", max_results=5)
+    return search_query
+
 
+def to_evidence(results: Dict[str, Any], source_type: str) -> List[ResearchEvidence]:
+    """Converts a Tavily response into a list of ResearchEvidence."""
     evidence = []
     for res in results.get("results", []):
         evidence.append(ResearchEvidence(
             source=source_type,
             content=res.get("content", ""),
             url=res.get("url", ""),
-            metadata={"title": res.get("title", "")}
+            metadata={"title": res.get("title", ""), "score": res.get("score")}
         ))
     return evidence
 
+# "adaptive" runs the cheaper and faster basic search first and repeats it with advanced depth only when
+# the results are not good enough, "basic" and "advanced" always use that depth.
+SEARCH_DEPTH = os.environ.get("SEARCH_DEPTH", "adaptive")
+SEARCH_MIN_RESULTS = int(os.environ.get("SEARCH_MIN_RESULTS", "3"))
+SEARCH_MIN_SCORE = float(os.environ.get("SEARCH_MIN_SCORE", "0.4"))
+SEARCH_MIN_CHARS = int(os.environ.get("SEARCH_MIN_CHARS", "1000"))
+
+def insufficient_reason(evidence: List[ResearchEvidence]) -> Optional[str]:
+    """Returns why a basic search is not good enough, or None if it is."""
+    if len(evidence) < SEARCH_MIN_RESULTS:
+        return "too_few_results"
+    scores = [e["metadata"]["score"] for e in evidence if e["metadata"].get("score") is not None]
+    if scores and sum(scores) / len(scores) < SEARCH_MIN_SCORE:
+        return "low_relevance"
+    if sum(len(e["content"]) for e in evidence) < SEARCH_MIN_CHARS:
+        return "too_little_text"
+    return None
+
+def record_depth(evidence: List[ResearchEvidence], source_type: str, depth: str, decision: str) -> List[ResearchEvidence]:
+    """Notes the search depth and why it was chosen in the metadata of every result."""
+    for item in evidence:
+        item["metadata"]["search_depth"] = depth
+        item["metadata"]["depth_decision"] = decision
+    registry.inc("search_depth", source=source_type, depth=depth, decision=decision.split(":")[0])
+    return evidence
+
+def tavily_search(tavily, query: str, source_type: str, depth: str, start_date: Optional[str] = None) -> List[ResearchEvidence]:
+    # timed inside the rate limited call, the time spent waiting for budget is rate_limit_wait_seconds
+    def search():
+        with registry.timer("tavily_seconds", source=source_type, depth=depth):
+            return tavily.search(query=build_search_query(query, source_type), search_depth=depth, max_results=5, start_date=start_date)
+
+    results = ratelimit.call("tavily", search)
+    registry.inc("tavily_calls", source=source_type, depth=depth)
+    return to_evidence(results, source_type)
+
+async def atavily_search(tavily, query: str, source_type: str, depth: str, start_date: Optional[str] = None) -> List[ResearchEvidence]:
+    async def search():
+        with registry.timer("tavily_seconds", source=source_type, depth=depth):
+            return await tavily.search(query=build_search_query(query, source_type), search_depth=depth, max_results=5, start_date=start_date)
+
+    results = await ratelimit.acall("tavily", search)
+    registry.inc("tavily_calls", source=source_type, depth=depth)
+    return to_evidence(results, source_type)
+
+# This is the core search function used by all three researchers (Amazon, Reddit, Web). It uses the Tavily API to find relevant information about the product.
+@traceable
+def perform_search(query: str, source_type: str, start_date: Optional[str] = None) -> List[ResearchEvidence]:
+    """Performs search and returns list of ResearchEvidence.
+
+    With start_date (YYYY-MM-DD, used by refresh mode) only results published since then are returned.
+    """
+
+    # Popular products get researched again and again, so we check the search cache first
+    # (not for refresh searches, their results depend on the date)
+    cache = get_search_cache() if not start_date else None
+    if cache:
+        cached = cache.get(query, source_type)
+        if cached is not None:
+            return cached
+
+    tavily = get_tavily()
+    if start_date:
+        # a refresh expects only a few new results, escalating because of that would just cost more
+        depth = "basic" if SEARCH_DEPTH == "adaptive" else SEARCH_DEPTH
+        evidence = record_depth(tavily_search(tavily, query, source_type, depth, start_date), source_type, depth, "refresh")
+    elif SEARCH_DEPTH != "adaptive":
+        evidence = record_depth(tavily_search(tavily, query, source_type, SEARCH_DEPTH), source_type, SEARCH_DEPTH, "fixed")
+    else:
+        evidence = tavily_search(tavily, query, source_type, "basic")
+        reason = insufficient_reason(evidence)
+        if reason is None:
+            record_depth(evidence, source_type, "basic", "sufficient")
+        else:
+            advanced = tavily_search(tavily, query, source_type, "advanced")
+            # keep the basic results if the advanced search comes back empty
+            depth = "advanced" if advanced else "basic"
+            evidence = advanced or evidence
+            record_depth(evidence, source_type, depth, f"escalated:{reason}")
+
+    if cache and evidence:
+        cache.put(query, source_type, evidence)
+    return evidence
+
+# Same as perform_search but awaits the shared async client, so the three researchers (and other runs) share one event loop instead of blocking a thread each.
+@traceable
+async def aperform_search(query: str, source_type: str, start_date: Optional[str] = None) -> List[ResearchEvidence]:
+    """Performs search asynchronously and returns list of ResearchEvidence."""
+
+    cache = get_search_cache() if not start_date else None
+    if cache:
+        cached = cache.get(query, source_type)
+        if cached is not None:
+            return cached
+
+    tavily = get_async_tavily()
+    if start_date:
+        depth = "basic" if SEARCH_DEPTH == "adaptive" else SEARCH_DEPTH
+        evidence = record_depth(await atavily_search(tavily, query, source_type, depth, start_date), source_type, depth, "refresh")
+    elif SEARCH_DEPTH != "adaptive":
+        evidence = record_depth(await atavily_search(tavily, query, source_type, SEARCH_DEPTH), source_type, SEARCH_DEPTH, "fixed")
+    else:
+        evidence = await atavily_search(tavily, query, source_type, "basic")
+        reason = insufficient_reason(evidence)
+        if reason is None:
+            record_depth(evidence, source_type, "basic", "sufficient")
+        else:
+            advanced = await atavily_search(tavily, query, source_type, "advanced")
+            depth = "advanced" if advanced else "basic"
+            evidence = advanced or evidence
+            record_depth(evidence, source_type, depth, f"escalated:{reason}")
+
+    if cache and evidence:
+        cache.put(query, source_type, evidence)
+    return evidence
+
 # Now we will define three parallel research agents that gather information from different sources. they all  willrun parallely in the research subgraph.
 
 def researcher_amazon(state: AgentState) -> Dict[str, Any]:
     """Searches Amazon and e-commerce reviews."""
     product_query = state.get("product_query") or state.get("product_link", "product")
-    evidence = perform_search(product_query, "amazon")
-    return {"research_evidence": evidence}
+    evidence = perform_search(product_query, "amazon", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
 
 def researcher_reddit(state: AgentState) -> Dict[str, Any]:
     """Searches Reddit for real opinions."""
     product_query = state.get("product_query") or state.get("product_link", "product")
-    evidence = perform_search(product_query, "reddit")
-    return {"research_evidence": evidence}
+    evidence = perform_search(product_query, "reddit", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
 
 def researcher_web(state: AgentState) -> Dict[str, Any]:
     """Searches general web for blogs and videos."""
     product_query = state.get("product_query") or state.get("product_link", "product")
-    evidence = perform_search(product_query, "web")
-    return {"research_evidence": evidence}
+    evidence = perform_search(product_query, "web", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
+
+# Async versions of the researchers, these are used when the graph is run with app.ainvoke / app.astream.
+
+async def aresearcher_amazon(state: AgentState) -> Dict[str, Any]:
+    """Searches Amazon and e-commerce reviews asynchronously."""
+    product_query = state.get("product_query") or state.get("product_link", "product")
+    evidence = await aperform_search(product_query, "amazon", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
+
+async def aresearcher_reddit(state: AgentState) -> Dict[str, Any]:
+    """Searches Reddit for real opinions asynchronously."""
+    product_query = state.get("product_query") or state.get("product_link", "product")
+    evidence = await aperform_search(product_query, "reddit", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
+
+async def aresearcher_web(state: AgentState) -> Dict[str, Any]:
+    """Searches general web for blogs and videos asynchronously."""
+    product_query = state.get("product_query") or state.get("product_link", "product")
+    evidence = await aperform_search(product_query, "web", start_date=state.get("search_since"))
+    return {"research_evidence": store_evidence(evidence)}
+
+def state_evidence(state) -> List[ResearchEvidence]:
+    """Loads the evidence the state refers to (it only holds refs, see evidence_store.py), deduplicated once dedupe_evidence ran."""
+    return load_evidence(state.get("unique_evidence") or state.get("research_evidence"))
+
+@traceable
+def dedupe_evidence(state: AgentState) -> Dict[str, Any]:
+    """Removes the syndicated/mirrored copies the three researchers often return for the same review."""
+    unique = dedupe_evidence_list(load_evidence(state["research_evidence"]))
+    print(f"Evidence: {len(state['research_evidence'])} snippets, {len(unique)} unique")
+    return {"unique_evidence": store_evidence(unique)}
+
+# Refresh mode regenerates the report only when the new evidence is material: at least this many new relevant
+# snippets, or new text amounting to this share of the stored evidence
+REFRESH_MIN_NEW_ITEMS = int(os.environ.get("REFRESH_MIN_NEW_ITEMS", "3"))
+REFRESH_MIN_NEW_SHARE = float(os.environ.get("REFRESH_MIN_NEW_SHARE", "0.15"))
+REFRESH_MIN_RELEVANCE = 1.0
+
+@traceable
+def merge_refresh(state: AgentState) -> Dict[str, Any]:
+    """Refresh mode: merges the new search results into the stored evidence and decides whether that is material.
+
+    unique_evidence holds the stored evidence of the last run, research_evidence only what the searches since then found.
+    """
+    product_query = state.get("product_query") or ""
+    previous = load_evidence(state.get("unique_evidence"))
+    merged = dedupe_evidence_list(previous + load_evidence(state["research_evidence"]))
+
+    # dedupe keeps the first copy, so whatever survives with a url we did not have is new information
+    previous_urls = {e.get("url") for e in previous}
+    new = [e for e in merged if e.get("url") not in previous_urls]
+    relevant = [e for e in new if relevance(e, product_query) >= REFRESH_MIN_RELEVANCE]
+    previous_tokens = sum(count_tokens(e.get("content") or "") for e in previous)
+    new_tokens = sum(count_tokens(e.get("content") or "") for e in relevant)
+    material = not previous or len(relevant) >= REFRESH_MIN_NEW_ITEMS or new_tokens >= REFRESH_MIN_NEW_SHARE * previous_tokens
+
+    by_source = {}
+    for item in new:
+        by_source[item["source"]] = by_source.get(item["source"], 0) + 1
+    print(f"Refresh: {len(new)} new snippets ({len(relevant)} relevant), material: {material}")
+    return {
+        "unique_evidence": store_evidence(merged),
+        "refresh": {
+            "since": state.get("search_since"),
+            "new_items": len(new),
+            "relevant_new_items": len(relevant),
+            "new_by_source": by_source,
+            "new_urls": [e["url"] for e in relevant if e.get("url")][:10],
+            "material": material,
+        },
+    }
+
+@traceable
+def pack_evidence(state: AgentState) -> Dict[str, Any]:
+    """Ranks the evidence and packs it under a token budget once, harvest_reviews and generate_report both use it.
+
+    The packed text goes to the evidence store like the evidence itself, the state only keeps its ref.
+    """
+    product_query = state.get("product_query") or ""
+    text = pack_evidence_text(state_evidence(state), product_query)
+    ref = store_evidence([{"source": "packed", "content": text, "url": None, "metadata": {"product_query": product_query}}])[0]
+    return {"packed_evidence_ref": ref}
+
+def packed_evidence(state, evidence: Optional[List[ResearchEvidence]] = None) -> str:
+    """The evidence block pack_evidence stored, packed again if there is none (or it is gone from the store)."""
+    ref = state.get("packed_evidence_ref")
+    stored = load_evidence([ref]) if ref else []
+    if stored:
+        return stored[0]["content"]
+    if evidence is None:
+        evidence = state_evidence(state)
+    return pack_evidence_text(evidence, state.get("product_query") or "")
 
 @traceable
 def harvest_reviews(state: AgentState) -> Dict[str, Any]:
     """Analyzes sentiment and topics using LLM."""
 
-    # Check if we have evidence
-    if not state['research_evidence']:
+    # Check if we have evidence (in refresh mode research_evidence only has the new results)
+    if not (state.get("unique_evidence") or state['research_evidence']):
         return {"reviews_analysis": None}
 
+    evidence = state_evidence(state)
+    # Ratings the product page told us (structured_data.py) are exact, the model only estimates the rest
+    known = known_ratings(state.get("product_data"))
+    topics_only = len(known) == 3
+    registry.inc("harvest_ratings", source="page" if topics_only else "partial" if known else "llm")
+
+    mode = HARVEST_MODE
+    if mode == "auto":
+        total_tokens = sum(count_tokens(e.get("content") or "") for e in evidence)
+        mode = "mapreduce" if total_tokens > EVIDENCE_TOKEN_BUDGET else "single"
+
+    if mode == "mapreduce":
+        return {"reviews_analysis": apply_known_ratings(harvest_reviews_mapreduce(evidence, topics_only), known)}
 
     llm = get_llm()
 
-    evidence_text = "\n".join([f"[{e['source']}] {e['content']}" for e in state['research_evidence']])
+    evidence_text = packed_evidence(state, evidence)
 
+    if topics_only:
+        keys = "positive_topics (list), negative_topics (list)."
+    else:
+        keys = """positive_topics (list), negative_topics (list), 
+        rating_distribution (dict 1-5 stars, estimate if needed), average_rating (float), total_reviews (int estimate)."""
     prompt = ChatPromptTemplate.from_template(
         """Analyze the following product research evidence and extract sentiment insights.
-        Return a valid JSON object with keys: positive_topics (list), negative_topics (list), 
-        rating_distribution (dict 1-5 stars, estimate if needed), average_rating (float), total_reviews (int estimate).
+        Return a valid JSON object with keys: {keys}
 
         Evidence:
         {evidence}
@@ -172,22 +550,67 @@ def harvest_reviews(state: AgentState) -> Dict[str, Any]:
     )
     chain = prompt | llm
     try:
-        res = chain.invoke({"evidence": evidence_text[:10000]})
+        res = chain.invoke({"keys": keys, "evidence": evidence_text})
         content = clean_json(res.content)
         data = json.loads(content)
-        return {"reviews_analysis": data}
+        return {"reviews_analysis": apply_known_ratings(data, known)}
     except Exception as e:
         print(f"Error in harvesting reviews: {e}")
         return {"reviews_analysis": None}
 
+def harvest_reviews_mapreduce(evidence: List[ResearchEvidence], topics_only: bool = False) -> Any:
+    """Map step: one LLM call per evidence chunk, all in parallel. Reduce step: merge_sentiment (no LLM).
+
+    Latency follows the largest chunk instead of the whole evidence, and no snippet is cut off.
+    With topics_only the chunks are not asked for ratings (the caller has the real ones).
+    """
+    llm = get_llm()
+    chunks = chunk_evidence(evidence)
+
+    if topics_only:
+        keys = "positive_topics (list of short topic names), negative_topics (list of short topic names)."
+    else:
+        keys = """positive_topics (list of short topic names), negative_topics (list of short topic names),
+        rating_distribution (dict "1"-"5" to number of ratings seen or estimated in this part), average_rating (float, 0 if unknown),
+        total_reviews (int, number of distinct reviews or opinions in this part)."""
+    prompt = ChatPromptTemplate.from_template(
+        """Analyze this part of the product research evidence and extract sentiment insights from it only.
+        Return a valid JSON object with keys: {keys}
+
+        Evidence:
+        {evidence}
+        """
+    )
+    chain = prompt | llm
+    responses = chain.batch(
+        [{"keys": keys, "evidence": chunk} for chunk in chunks],
+        config={"max_concurrency": MAP_CONCURRENCY},
+        return_exceptions=True,
+    )
+
+    partials = []
+    for response in responses:
+        if isinstance(response, Exception):
+            print(f"Error in harvesting reviews chunk: {response}")
+            continue
+        try:
+            partials.append(json.loads(clean_json(response.content)))
+        except json.JSONDecodeError as e:
+            print(f"Error in harvesting reviews chunk: {e}")
+    print(f"Sentiment: {len(partials)}/{len(chunks)} chunks analyzed")
+    return merge_sentiment(partials)
+
 @traceable
-def generate_report(state: AgentState) -> Dict[str, Any]:
-    """Generates the final markdown-formatted report using LLM."""
+def generate_report(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Generates the final markdown-formatted report using LLM.
+
+    The config is passed on to the LLM call so app.stream(..., stream_mode="messages") receives the report token by token.
+    """
     print("--- Generating Report ---")
 
     llm = get_llm()
 
-    evidence_text = "\n".join([f"[{e['source']}] {e['content']}" for e in state['research_evidence']])
+    evidence_text = packed_evidence(state)
     analysis_text = json.dumps(state.get("reviews_analysis") or {})
 
     prompt = ChatPromptTemplate.from_template(
@@ -246,50 +669,165 @@ def generate_report(state: AgentState) -> Dict[str, Any]:
 
     res = chain.invoke({
         "product": state["product_query"],
-        "evidence": evidence_text[:20000],
+        "evidence": evidence_text,
         "analysis": analysis_text
-    })
-
-    report = res.content.strip()
+    }, config=config)
 
-    # Clean markdown code blocks if present
-    if report.startswith("```markdown"):
-        report = report[11:]
-    elif report.startswith("```"):
-        report = report[3:]
-    if report.endswith("```"):
-        report = report[:-3]
+    report = clean_markdown(res.content)
 
-    report = report.strip()
+    # Build the chat retrieval index for this thread now, so the first follow-up question does not pay for it
+    thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+    get_index(thread_id, report, state.get("unique_evidence") or state["research_evidence"])
 
     return {
         "final_report": report,
-        "messages": [AIMessage(content=report)]
+        "messages": [report_message(report)]
     }
 
-# Chat Nodes & Persistence Stage
+# Evidence budget of the whole comparison prompt, split evenly between the products
+COMPARE_TOKEN_BUDGET = int(os.environ.get("COMPARE_TOKEN_BUDGET", "6000"))
 
 @traceable
-def chat_node(state: AgentState) -> Dict[str, Any]:
-    """Answers user questions based on the generated report and web search."""
+def generate_comparison(state: ComparisonState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Writes one comparative markdown report from the research of every product in the comparison."""
+    print("--- Generating Comparison ---")
+
     llm = get_llm()
 
-    # Define tools
-    tools = [TavilySearchResults(max_results=3)]
-    llm_with_tools = llm.bind_tools(tools)
+    # the branches finish in any order, the report follows the order the user gave
+    order = {url: i for i, url in enumerate(state["product_links"])}
+    products = sorted(state["products"], key=lambda p: order.get(p["product_link"], len(order)))
+    budget = max(500, COMPARE_TOKEN_BUDGET // max(1, len(products)))
+
+    sections = []
+    names = []
+    for i, product in enumerate(products, 1):
+        name = product.get("product_query") or product["product_link"]
+        names.append(name)
+        if product.get("error"):
+            body = f"Research failed: {product['error']}"
+        elif product.get("unique_evidence"):
+            body = "Evidence:\n" + pack_evidence_text(load_evidence(product["unique_evidence"]), name, budget=budget)
+        elif product.get("final_report"):
+            # served from the report cache, its report stands in for the evidence
+            body = "Earlier report:\n" + product["final_report"][:budget * 4]
+        else:
+            body = "No evidence found."
+        analysis = json.dumps(product.get("reviews_analysis") or {})
+        sections.append(f"### Product {i}: {name}\nLink: {product['product_link']}\nSentiment Analysis: {analysis}\n{body}")
 
-    report = state.get("final_report", "No report available.")
-    summary = state.get("summary", "")
+    prompt = ChatPromptTemplate.from_template(
+        """You are a product research analyst. Generate a concise, evidence-based comparison report of these products: {products}.
+
+            Use the following structure:
+
+            1. Comparison Summary
+            One line per product: name, category, 1 sentence verdict.
+            Overall Pick: which product suits most buyers and why.
+
+            2. Side-by-Side Table
+            A markdown table with one column per product and rows for average rating, key strengths,
+            key weaknesses, most mentioned issues and value for money.
+
+            3. Head-to-Head
+            Where each product clearly beats the others, backed by quotes from the evidence in this format:
+            [Product – Source] "Exact quote"
+
+            4. Recommendation
+            Choose [product] if: 2–3 scenarios per product
+
+            5. Confidence Score
+            Analysis Confidence: [X%], lower when a product has little or no evidence.
+
+            Instructions:
+            Only use provided evidence.
+            Do not fabricate information, say so when a product lacks data.
+
+            Products:
+            {sections}"""
+    )
+
+    chain = prompt | llm
+    res = chain.invoke({"products": ", ".join(names), "sections": "\n\n".join(sections)}, config=config)
+
+    evidence = [ref for product in products for ref in product.get("unique_evidence") or []]
+    return {
+        "final_report": clean_markdown(res.content),
+        "product_query": " vs ".join(names),
+        "unique_evidence": evidence,
+    }
+
+# Chat Nodes & Persistence Stage
+
+def get_chat_tools():
+    """Returns the chat tools, created once per process."""
+    global _chat_tools
+    if _chat_tools is None:
+        _chat_tools = [TavilySearchResults(max_results=3)]
+    return _chat_tools
+
+_chat_tools = None
+_chat_llm = None
+
+def get_chat_llm():
+    """Returns the LLM with the chat tools bound, built once instead of on every turn."""
+    global _chat_llm
+    if _chat_llm is None:
+        _chat_llm = get_llm().bind_tools(get_chat_tools())
+    return _chat_llm
+
+def report_message(report: str) -> AIMessage:
+    """The report as the first answer of the chat thread, marked so chat_node can leave it out of its prompts."""
+    return AIMessage(content=report, name="report")
+
+def chat_history(state: AgentState) -> List[Any]:
+    """The conversation without the report messages, the report reaches the prompt only as retrieved passages."""
+    report = state.get("final_report")
+    # threads from before the report messages were marked are recognized by their content
+    return [
+        m for m in state["messages"]
+        if not (isinstance(m, AIMessage) and (m.name == "report" or (report and m.content == report)))
+    ]
 
-    system_msg = f"""You are a helpful product research assistant. 
-    You have generated a detailed report about a product. 
-    Answer the user's follow-up questions based on this report.
+@traceable
+def chat_node(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Answers user questions based on the generated report and web search.
+
+    Instead of the whole report only the report sections and evidence snippets most relevant
+    to the question (BM25 over a per-thread index) go into the prompt.
+    """
+    llm_with_tools = get_chat_llm()
 
-    If the user asks for information NOT in the report (like current price, new models, or specific details), 
+    report = state.get("final_report") or "No report available."
+    summary = state.get("summary", "")
+    evidence_refs = state.get("unique_evidence") or state.get("research_evidence") or []
+
+    # the question we retrieve for is the latest user message (right after the report there is none yet)
+    question = ""
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            question = message.content
+            break
+
+    thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+    index = get_index(thread_id, report, evidence_refs)
+    sections = split_report(report)
+    # the summary/verdict section is always useful, the rest is picked by relevance
+    passages = index.search(f"{state.get('product_query') or ''} {question}") if question else []
+    overview = sections[0] if sections else report
+    context = "Report overview:\n" + overview
+    passages = [p for p in passages if p["text"] != overview]
+    if passages:
+        context += "\n\nRelevant report sections and evidence:\n" + format_passages(passages)
+
+    system_msg = """You are a helpful product research assistant. 
+    You have generated a detailed report about {product}. 
+    Answer the user's follow-up questions based on the report excerpts and research evidence below.
+
+    If the answer is NOT in them (like current price, new models, or specific details), 
     use the 'tavily_search_results_json' tool to find the answer.
 
-    Report Content:
-    {report}
+    {context}
 
     Conversation Summary:
     {summary}
@@ -301,41 +839,153 @@ def chat_node(state: AgentState) -> Dict[str, Any]:
     ])
 
     chain = prompt | llm_with_tools
-    response = chain.invoke({"messages": state["messages"]})
+    response = chain.invoke({
+        "product": state.get("product_query") or "a product",
+        "context": context,
+        "summary": summary,
+        "messages": chat_history(state),
+    }, config=config)
 
     return {"messages": [response]}
 
+def previous_tool_results(messages) -> Dict[str, str]:
+    """Maps the normalized queries the chat already searched in this thread to their tool results."""
+    queries = {}
+    results = {}
+    for message in messages:
+        if isinstance(message, AIMessage):
+            for call in message.tool_calls:
+                queries[call["id"]] = normalize_query(str(call["args"].get("query", "")))
+        elif isinstance(message, ToolMessage) and message.tool_call_id in queries and message.status != "error":
+            results[queries[message.tool_call_id]] = message.content
+    return results
+
+def chat_tools(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Runs the search tool calls of chat_node, avoiding Tavily wherever we can.
+
+    For every query (normalized, so "Battery life?" and "battery life" are the same) we try in order:
+    the same query earlier in this call or thread, the research evidence of the run, the shared
+    search cache, and only then a real search.
+    """
+    tool = get_chat_tools()[0]
+    messages = state["messages"]
+    previous = previous_tool_results(messages[:-1])
+    cache = get_search_cache()
+    index = None
+    answered = {}
+    tool_messages = []
+
+    for call in messages[-1].tool_calls:
+        if call["name"] != tool.name:
+            tool_messages.append(ToolMessage(content=f"Error: {call['name']} is not a valid tool.", tool_call_id=call["id"],
+                                             name=call["name"], status="error"))
+            continue
+
+        query = str(call["args"].get("query", ""))
+        key = normalize_query(query)
+        if key in answered:
+            content, served = answered[key], "duplicate"
+        elif key in previous:
+            content, served = previous[key], "thread"
+        else:
+            if index is None:
+                thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+                evidence_refs = state.get("unique_evidence") or state.get("research_evidence") or []
+                index = get_index(thread_id, state.get("final_report") or "", evidence_refs)
+            results, served = answer_from_evidence(index, query, ignore=state.get("product_query") or ""), "evidence"
+
+            if results is None and cache:
+                cached = cache.get(query, "chat")
+                if cached is not None:
+                    results, served = [{"url": e["url"], "content": e["content"]} for e in cached], "cache"
+
+            if results is None:
+                # same search the tool would run (it searches in advanced depth), but through the shared client and rate limits
+                tavily = get_tavily()
+
+                def search():
+                    with registry.timer("tavily_seconds", source="chat"):
+                        return tavily.search(query=query, search_depth=tool.search_depth, max_results=tool.max_results)
+
+                response = ratelimit.call("tavily", search)
+                registry.inc("tavily_calls", source="chat")
+                results = [{"url": r.get("url"), "content": r.get("content", "")} for r in response.get("results", [])]
+                served = "search"
+                if cache and isinstance(results, list) and results:
+                    cache.put(query, "chat", [
+                        {"source": "chat", "content": r.get("content", ""), "url": r.get("url"), "metadata": {}} for r in results
+                    ])
+            content = results if isinstance(results, str) else json.dumps(results)
+
+        answered[key] = content
+        registry.inc("chat_tool_calls", served=served)
+        tool_messages.append(ToolMessage(content=content, tool_call_id=call["id"], name=call["name"]))
+
+    return {"messages": tool_messages}
+
+# The conversation is summarized once the messages in the thread reach this many tokens,
+# the most recent SUMMARY_KEEP_TOKENS worth of messages stay verbatim
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", "3000"))
+SUMMARY_KEEP_TOKENS = int(os.environ.get("SUMMARY_KEEP_TOKENS", "800"))
+
+def message_tokens(message) -> int:
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+    return count_tokens(content) + 4
+
+def summary_cutoff(messages) -> int:
+    """Returns how many of the oldest messages should be folded into the summary (0 while under the trigger)."""
+    sizes = [message_tokens(m) for m in messages]
+    if sum(sizes) <= SUMMARY_TRIGGER_TOKENS:
+        return 0
+
+    # keep the newest messages up to SUMMARY_KEEP_TOKENS, but at least the last 2
+    cutoff, kept = len(messages), 0
+    while cutoff > 0 and (len(messages) - cutoff < 2 or kept + sizes[cutoff - 1] <= SUMMARY_KEEP_TOKENS):
+        cutoff -= 1
+        kept += sizes[cutoff]
+    # never keep a tool result without the tool call it answers
+    while cutoff > 0 and isinstance(messages[cutoff], ToolMessage):
+        cutoff -= 1
+    return cutoff
+
 @traceable
 def summarize_conversation(state: AgentState) -> Dict[str, Any]:
-    """Summarizes the conversation and removes old messages to save memory """
-    llm = get_llm()
+    """Folds the messages added since the last summary into it and removes them from the thread.
+
+    Only the messages after the watermark (the last message already in the summary) are sent,
+    so the input stays small however long the chat gets. Returns an empty update when there is
+    nothing to do.
+    """
     summary = state.get("summary", "")
     messages = state["messages"]
+    cutoff = summary_cutoff(messages)
+    if cutoff == 0:
+        return {}
+
+    # messages up to the watermark are already in the summary (their removal may have been lost to a concurrent turn)
+    ids = [m.id for m in messages]
+    watermark = state.get("summary_watermark")
+    start = ids.index(watermark) + 1 if watermark in ids[:cutoff] else 0
+    new_messages = messages[start:cutoff]
+
+    if new_messages:
+        llm = get_llm()
+        if summary:
+            summary_prompt = f"Previous summary: {summary}\n\nNew lines of conversation:\n"
+        else:
+            summary_prompt = "Summarize the conversation so far:\n"
+
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", "Distill the following conversation into a concise summary."),
+            ("user", "{summary_prompt}"),
+            MessagesPlaceholder(variable_name="messages"),
+        ])
 
-    if summary:
-        summary_prompt = f"Previous summary: {summary}\n\nNew lines of conversation:\n"
-    else:
-        summary_prompt = "Summarize the conversation so far:\n"
-
-    # Create prompt for summarization
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "Distill the following conversation into a concise summary."),
-        ("user", summary_prompt),
-        MessagesPlaceholder(variable_name="messages"),
-    ])
-
-    chain = prompt | llm
-    res = chain.invoke({"messages": messages})
-    new_summary = res.content
-
-    # Keep last 2 messages
-    cutoff = max(0, len(messages) - 2)
-    while cutoff > 0 and isinstance(messages[cutoff], ToolMessage):
-        cutoff -= 1
-
-    delete_messages = [RemoveMessage(id=m.id) for m in messages[:cutoff]]
+        chain = prompt | llm
+        summary = chain.invoke({"summary_prompt": summary_prompt, "messages": new_messages}).content
 
     return {
-        "summary": new_summary,
-        "messages": delete_messages
+        "summary": summary,
+        "summary_watermark": ids[cutoff - 1],
+        "messages": [RemoveMessage(id=m.id) for m in messages[:cutoff]],
     }
@@ -0,0 +1,240 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower runs first. Chat turns are interactive, web/API research is research,
+# the batch runner and background summaries are background.
+PRIORITIES = {"interactive": 0, "research": 1, "background": 2}
+current_priority: ContextVar[str] = ContextVar("current_priority", default="research")
+
+# Provider quotas per minute, set them to what your account actually has
+LIMITS = {
+    "openai": {
+        "requests": float(os.environ.get("OPENAI_RPM", "500")),
+        "tokens": float(os.environ.get("OPENAI_TPM", "200000")),
+    },
+    "tavily": {
+        "requests": float(os.environ.get("TAVILY_RPM", "100")),
+    },
+}
+RETRY_ATTEMPTS = int(os.environ.get("PROVIDER_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_SECONDS = float(os.environ.get("PROVIDER_RETRY_BASE_SECONDS", "1"))
+RETRY_MAX_SECONDS = 30.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+@contextmanager
+def priority(name: str):
+    """Runs the calls made inside the block (also in graph nodes, they inherit the context) with this priority."""
+    token = current_priority.set(name)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    """Refills at limit per minute up to a full minute's worth, so short bursts within the quota go through."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount is available (0 if it is)."""
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class ProviderScheduler:
+    """Hands out request (and token) budget of one provider in priority order, first come first served within a priority."""
+
+    def __init__(self, name: str, limits: Dict[str, float]):
+        self.name = name
+        self.buckets = {kind: TokenBucket(limit) for kind, limit in limits.items() if limit > 0}
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+
+    def _try_acquire(self, entry, amounts: Dict[str, float]) -> Optional[float]:
+        """Takes the budget if entry is first in line and it is available, returns 0 then, else how long to wait.
+
+        None means entry is not first in line, it has to wait until the line moves (the condition is notified then).
+        """
+        now = time.monotonic()
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+        if self._waiting[0] != entry:
+            return None
+        wait = max([self.buckets[kind].wait_time(amount) for kind, amount in amounts.items() if kind in self.buckets] or [0.0])
+        if wait > 0:
+            return wait
+        for kind, amount in amounts.items():
+            if kind in self.buckets:
+                self.buckets[kind].take(amount)
+        heapq.heappop(self._waiting)
+        self._cond.notify_all()
+        return 0.0
+
+    def _leave(self, entry) -> None:
+        """Drops a waiter that gave up (cancelled task, interrupt), so it does not block the line."""
+        with self._cond:
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def _enqueue(self, tokens: float):
+        entry = (PRIORITIES.get(current_priority.get(), 1), next(self._seq))
+        heapq.heappush(self._waiting, entry)
+        return entry, {"requests": 1, "tokens": tokens}
+
+    def _record_wait(self, start: float) -> None:
+        registry.observe("rate_limit_wait_seconds", time.monotonic() - start, provider=self.name, priority=current_priority.get())
+
+    def acquire(self, tokens: float = 0) -> None:
+        start = time.monotonic()
+        with self._cond:
+            entry, amounts = self._enqueue(tokens)
+            try:
+                while True:
+                    wait = self._try_acquire(entry, amounts)
+                    if wait == 0:
+                        break
+                    # the head waits for the buckets to refill, the others until an acquire or _leave notifies
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                self._leave(entry)
+                raise
+        self._record_wait(start)
+
+    async def aacquire(self, tokens: float = 0) -> None:
+        start = time.monotonic()
+        with self._cond:
+            entry, amounts = self._enqueue(tokens)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_acquire(entry, amounts)
+                if wait == 0:
+                    break
+                # a condition wait would block the event loop, async waiters poll instead
+                await asyncio.sleep(0.01 if wait is None else min(wait, 0.25))
+        except BaseException:
+            self._leave(entry)
+            raise
+        self._record_wait(start)
+
+    def penalize(self, seconds: float) -> None:
+        """Empties the request bucket after a 429, so everyone backs off instead of only the caller that got it."""
+        with self._cond:
+            bucket = self.buckets.get("requests")
+            if bucket:
+                bucket.refill(time.monotonic())
+                bucket.level = min(bucket.level, -bucket.rate * seconds)
+
+    def queue_depth(self) -> Dict[str, int]:
+        with self._cond:
+            depth = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for prio, _ in self._waiting:
+                depth[names.get(prio, "research")] += 1
+        return depth
+
+
+_schedulers = {name: ProviderScheduler(name, limits) for name, limits in LIMITS.items()}
+registry.gauge("rate_limit_queue", lambda: {
+    f"{name}_{prio}": depth for name, scheduler in _schedulers.items() for prio, depth in scheduler.queue_depth().items()
+}, "Calls waiting for provider budget, by provider and priority")
+
+
+def get_scheduler(provider: str) -> ProviderScheduler:
+    return _schedulers[provider]
+
+
+def classify_error(exc: BaseException) -> Optional[str]:
+    """Returns "rate_limited" or "transient" for errors worth retrying, None for the rest."""
+    name = type(exc).__name__
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    # Tavily raises UsageLimitExceededError for its 429s
+    if status == 429 or "RateLimit" in name or name == "UsageLimitExceededError":
+        return "rate_limited"
+    if status in RETRYABLE_STATUS or isinstance(exc, (TimeoutError, ConnectionError)) or "Timeout" in name or "Connection" in name:
+        return "transient"
+    return None
+
+
+def retry_delay(exc: BaseException, attempt: int) -> float:
+    """Retry-After if the provider sent one, else exponential backoff with full jitter."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+def should_retry(provider: str, exc: Exception, attempt: int) -> Optional[float]:
+    """Returns how long to wait before retrying the failed call, None if it should not be retried."""
+    kind = classify_error(exc)
+    if kind is None or attempt + 1 >= RETRY_ATTEMPTS:
+        return None
+    delay = retry_delay(exc, attempt)
+    if kind == "rate_limited":
+        get_scheduler(provider).penalize(delay)
+    registry.inc("provider_retries", provider=provider, reason=kind)
+    logger.warning("%s call failed (%s), retry %d in %.1fs", provider, exc, attempt + 1, delay)
+    return delay
+
+
+def call(provider: str, func: Callable[[], Any], tokens: float = 0) -> Any:
+    """Runs func under the provider's rate limits, retrying rate limit and transient errors with backoff."""
+    scheduler = get_scheduler(provider)
+    for attempt in itertools.count():
+        scheduler.acquire(tokens)
+        try:
+            return func()
+        except Exception as e:
+            delay = should_retry(provider, e, attempt)
+            if delay is None:
+                raise
+        time.sleep(delay)
+
+
+async def acall(provider: str, func: Callable[[], Any], tokens: float = 0) -> Any:
+    """Async version of call, func returns an awaitable."""
+    scheduler = get_scheduler(provider)
+    for attempt in itertools.count():
+        await scheduler.aacquire(tokens)
+        try:
+            return await func()
+        except Exception as e:
+            delay = should_retry(provider, e, attempt)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import threading
+from typing import Any, Dict, Optional
+
+from storage import connect, db_path
+from evidence_store import get_evidence_store
+
+# How old a cached report may be before we research the product again
+DEFAULT_MAX_AGE = float(os.environ.get("REPORT_CACHE_MAX_AGE_HOURS", "24")) * 60 * 60
+
+
+class ReportCache:
+    """SQLite cache of finished reports keyed by the canonical product key (see url_canonical.py)."""
+
+    def __init__(self, path: str, max_age: float = DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS report_cache (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                product_query TEXT,
+                final_report TEXT NOT NULL,
+                reviews_analysis TEXT,
+                created_at REAL NOT NULL,
+                evidence TEXT
+            )"""
+        )
+        # caches created before the evidence refs were stored (refresh mode starts from them)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(report_cache)")]
+        if "evidence" not in columns:
+            self._conn.execute("ALTER TABLE report_cache ADD COLUMN evidence TEXT")
+        self._conn.commit()
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Returns the cached report for the key if it is younger than max_age seconds."""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, product_query, final_report, reviews_analysis, created_at, evidence FROM report_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or time.time() - row[4] > max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+        url, product_query, final_report, reviews_analysis, created_at, evidence = row
+        return {
+            "product_link": url,
+            "product_query": product_query,
+            "final_report": final_report,
+            "reviews_analysis": json.loads(reviews_analysis) if reviews_analysis else None,
+            "unique_evidence": json.loads(evidence) if evidence else [],
+            "created_at": created_at,
+        }
+
+    def put(self, key: str, url: str, result: Dict[str, Any]) -> None:
+        """Stores the report and analysis of a finished run, with the refs of its evidence.
+
+        The refs are pinned in the evidence store, refresh mode needs them however old the report is.
+        """
+        evidence = result.get("unique_evidence") or result.get("research_evidence")
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO report_cache
+                   (key, url, product_query, final_report, reviews_analysis, created_at, evidence) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    key,
+                    url,
+                    result.get("product_query"),
+                    result["final_report"],
+                    json.dumps(result.get("reviews_analysis")) if result.get("reviews_analysis") else None,
+                    time.time(),
+                    json.dumps(evidence) if evidence else None,
+                ),
+            )
+            self._conn.commit()
+        get_evidence_store().pin(f"report:{key}", evidence or [])
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM report_cache WHERE key = ?", (key,))
+            self._conn.commit()
+        get_evidence_store().unpin(f"report:{key}")
+
+
+_report_cache = None
+_report_cache_lock = threading.Lock()
+
+
+def get_report_cache() -> ReportCache:
+    """Returns the shared report cache."""
+    global _report_cache
+    with _report_cache_lock:
+        if _report_cache is None:
+            _report_cache = ReportCache(os.environ.get("REPORT_CACHE_PATH") or db_path("report_cache.sqlite"))
+    return _report_cache
@@ -0,0 +1,157 @@
+import os
+import re
+import math
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional
+
+from state import ResearchEvidence
+from evidence_store import load_evidence, get_evidence_store
+
+# How many passages chat_node puts in its prompt
+TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "6"))
+# Indexes kept in memory, one per chat thread (older ones are rebuilt from the thread state when needed)
+MAX_INDEXES = 256
+MAX_PASSAGE_CHARS = 1200
+
+# Minimum share of the question's terms the evidence has to cover to answer a chat search without Tavily
+MIN_EVIDENCE_COVERAGE = float(os.environ.get("TOOL_EVIDENCE_MIN_COVERAGE", "0.8"))
+# Questions about these can only be answered by a fresh search, research evidence may be days old
+FRESHNESS_TERMS = {"price", "prices", "cost", "today", "current", "currently", "latest", "new", "newest", "deal",
+                   "deals", "sale", "discount", "stock", "available", "availability", "release", "released", "now"}
+
+STOPWORDS = set("""a an and are as at be but by for from has have how i if in is it its me my of on or so that the
+their them they this to was what when which who why will with you your does do did can could should would about""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def split_report(report: str) -> List[str]:
+    """Splits the markdown report into its sections (headings or "1. Product Summary" style numbered titles)."""
+    sections = re.split(r"\n(?=#{1,4} |\*\*\d+\.|\d+\.\s+[A-Z])", report)
+    passages = []
+    for section in sections:
+        section = section.strip()
+        while len(section) > MAX_PASSAGE_CHARS:
+            cut = section.rfind("\n", 0, MAX_PASSAGE_CHARS)
+            cut = cut if cut > MAX_PASSAGE_CHARS // 2 else MAX_PASSAGE_CHARS
+            passages.append(section[:cut].strip())
+            section = section[cut:].strip()
+        if section:
+            passages.append(section)
+    return passages
+
+
+class BM25Index:
+    """Small in-memory BM25 index over report sections and evidence snippets."""
+
+    def __init__(self, passages: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self._tfs = [Counter(tokenize(p["text"])) for p in passages]
+        self._lengths = [sum(tf.values()) for tf in self._tfs]
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        document_frequency = Counter()
+        for tf in self._tfs:
+            document_frequency.update(tf.keys())
+        n = len(passages)
+        self._idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in document_frequency.items()}
+
+    def search(self, query: str, k: int = TOP_K) -> List[Dict[str, Any]]:
+        """Returns the k best passages for the query, each with its "score"."""
+        terms = tokenize(query)
+        scored = []
+        for i, tf in enumerate(self._tfs):
+            score = 0.0
+            for term in terms:
+                if term not in tf:
+                    continue
+                freq = tf[term]
+                norm = 1 - self.b + self.b * self._lengths[i] / (self._avg_length or 1)
+                score += self._idf[term] * freq * (self.k1 + 1) / (freq + self.k1 * norm)
+            if score > 0:
+                scored.append((score, i))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [dict(self.passages[i], score=score) for score, i in scored[:k]]
+
+
+def build_index(report: str, evidence: List[ResearchEvidence]) -> BM25Index:
+    passages = [{"kind": "report", "source": "report", "url": None, "text": text} for text in split_report(report or "")]
+    for item in evidence:
+        if item.get("content"):
+            passages.append({
+                "kind": "evidence",
+                "source": item["source"],
+                "url": item.get("url"),
+                "text": item["content"][:MAX_PASSAGE_CHARS * 2],
+            })
+    return BM25Index(passages)
+
+
+def _fingerprint(report: str, evidence_refs: List[str]) -> str:
+    digest = hashlib.sha1((report or "").encode())
+    for ref in evidence_refs:
+        digest.update(ref.encode())
+    return digest.hexdigest()
+
+
+_indexes: "OrderedDict[str, Any]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(thread_id: Optional[str], report: str, evidence_refs: List[str]) -> BM25Index:
+    """Returns the index of the thread, building it if the thread has none yet or its report/evidence changed.
+
+    The evidence is only loaded from the evidence store when the index has to be built.
+    """
+    fingerprint = _fingerprint(report, evidence_refs)
+    if thread_id:
+        with _indexes_lock:
+            cached = _indexes.get(thread_id)
+            if cached and cached[0] == fingerprint:
+                _indexes.move_to_end(thread_id)
+            else:
+                cached = None
+        if cached:
+            # the evidence is not read from the store while the index is cached, it still counts as used
+            get_evidence_store().touch(evidence_refs)
+            return cached[1]
+    index = build_index(report, load_evidence(evidence_refs))
+    if thread_id:
+        with _indexes_lock:
+            _indexes[thread_id] = (fingerprint, index)
+            _indexes.move_to_end(thread_id)
+            while len(_indexes) > MAX_INDEXES:
+                _indexes.popitem(last=False)
+    return index
+
+
+def answer_from_evidence(index: BM25Index, query: str, ignore: str = "", k: int = 3) -> Optional[List[Dict[str, Any]]]:
+    """Returns evidence passages that cover the search query well enough, or None if it needs a real search.
+
+    Terms of `ignore` (the product name) do not count, snippets rarely repeat it.
+    """
+    terms = set(tokenize(query)) - set(tokenize(ignore))
+    if not terms or terms & FRESHNESS_TERMS or re.search(r"\b20\d\d\b", query):
+        return None
+    passages = [p for p in index.search(query, k * 2) if p["kind"] == "evidence"][:k]
+    covered = set()
+    for passage in passages:
+        covered |= terms & set(tokenize(passage["text"]))
+    if not passages or len(covered) / len(terms) < MIN_EVIDENCE_COVERAGE:
+        return None
+    return [{"url": p["url"], "content": p["text"]} for p in passages]
+
+
+def format_passages(passages: List[Dict[str, Any]]) -> str:
+    lines = []
+    for passage in passages:
+        label = "Report" if passage["kind"] == "report" else f"{passage['source']} evidence"
+        if passage.get("url"):
+            label += f" ({passage['url']})"
+        lines.append(f"[{label}]\n{passage['text']}")
+    return "\n\n".join(lines)
@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import time
+import threading
+from typing import Dict, List, Optional
+
+from state import ResearchEvidence
+from storage import connect, db_path
+
+HOUR = 60 * 60
+
+# How long search results stay fresh per source. Prices and listings move fast,
+# Reddit threads and expert reviews go stale a lot slower.
+DEFAULT_TTLS = {
+    "amazon": 6 * HOUR,
+    "reddit": 72 * HOUR,
+    "web": 24 * HOUR,
+    "chat": 6 * HOUR,  # searches the chat runs for follow-up questions, often about prices
+}
+DEFAULT_TTL = 24 * HOUR
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases the query and collapses punctuation/whitespace so trivially different queries share an entry."""
+    query = query.lower()
+    query = re.sub(r"[^\w\s.+-]", " ", query)
+    return " ".join(query.split())
+
+
+class SearchCache:
+    """SQLite backed cache of perform_search results with per-source TTLs and LRU eviction."""
+
+    def __init__(self, path: str, ttls: Optional[Dict[str, float]] = None, max_entries: int = 5000):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS search_cache (
+                query TEXT NOT NULL,
+                source TEXT NOT NULL,
+                evidence TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (query, source)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_access ON search_cache(last_access)")
+        self._conn.commit()
+
+    def ttl(self, source_type: str) -> float:
+        return self.ttls.get(source_type, DEFAULT_TTL)
+
+    def get(self, query: str, source_type: str) -> Optional[List[ResearchEvidence]]:
+        """Returns the cached evidence, or None if there is no fresh entry."""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT evidence, created_at FROM search_cache WHERE query = ? AND source = ?",
+                (key, source_type),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            evidence, created_at = row
+            if now - created_at > self.ttl(source_type):
+                self._conn.execute("DELETE FROM search_cache WHERE query = ? AND source = ?", (key, source_type))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE search_cache SET last_access = ? WHERE query = ? AND source = ?",
+                (now, key, source_type),
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(evidence)
+
+    def put(self, query: str, source_type: str, evidence: List[ResearchEvidence]) -> None:
+        """Stores the evidence for the query and evicts the least recently used entries over the size limit."""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (query, source, evidence, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, source_type, json.dumps(evidence), now, now),
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+            if count > self.max_entries:
+                cur = self._conn.execute(
+                    """DELETE FROM search_cache WHERE rowid IN (
+                        SELECT rowid FROM search_cache ORDER BY last_access ASC LIMIT ?
+                    )""",
+                    (count - self.max_entries,),
+                )
+                self.evictions += cur.rowcount
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM search_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss counters and the current number of entries."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": size,
+        }
+
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> Optional[SearchCache]:
+    """Returns the shared search cache, or None if it was turned off with SEARCH_CACHE=0."""
+    global _search_cache
+    if os.environ.get("SEARCH_CACHE", "1") == "0":
+        return None
+    with _search_cache_lock:
+        if _search_cache is None:
+            ttls = {}
+            for source in DEFAULT_TTLS:
+                value = os.environ.get(f"SEARCH_CACHE_TTL_{source.upper()}")
+                if value:
+                    ttls[source] = float(value)
+            _search_cache = SearchCache(
+                os.environ.get("SEARCH_CACHE_PATH") or db_path("search_cache.sqlite"),
+                ttls=ttls,
+                max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "5000")),
+            )
+    return _search_cache
@@ -0,0 +1,93 @@
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from state import SentimentAnalysis
+
+# How many topics of each kind the merged analysis keeps
+MAX_TOPICS = 8
+
+
+def _star_key(key: Any) -> Optional[str]:
+    """Maps "5", "5 stars", "five_star", 5 ... to "5"."""
+    words = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5"}
+    text = str(key).lower()
+    found = re.search(r"[1-5]", text)
+    if found:
+        return found.group(0)
+    for word, digit in words.items():
+        if word in text:
+            return digit
+    return None
+
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _merge_topics(partials: List[Dict[str, Any]], key: str) -> List[str]:
+    """Topics ranked by how many chunks mention them, ties broken by first appearance (so the result is deterministic)."""
+    counts = Counter()
+    first_seen = {}
+    spelling = {}
+    for partial in partials:
+        seen_here = set()
+        for topic in partial.get(key) or []:
+            if not isinstance(topic, str) or not topic.strip():
+                continue
+            normalized = " ".join(topic.lower().split())
+            if normalized in seen_here:
+                continue
+            seen_here.add(normalized)
+            counts[normalized] += 1
+            first_seen.setdefault(normalized, len(first_seen))
+            spelling.setdefault(normalized, topic.strip())
+    ranked = sorted(counts, key=lambda t: (-counts[t], first_seen[t]))
+    return [spelling[t] for t in ranked[:MAX_TOPICS]]
+
+
+def merge_sentiment(partials: List[Dict[str, Any]]) -> Optional[SentimentAnalysis]:
+    """Deterministic reducer for the per-chunk analyses of the map-reduce sentiment stage.
+
+    Topics are ranked by how many chunks mention them, star counts and review counts are summed,
+    and the average rating is weighted by the number of reviews each chunk saw.
+    """
+    partials = [p for p in partials if isinstance(p, dict)]
+    if not partials:
+        return None
+
+    distribution = {str(star): 0 for star in range(1, 6)}
+    total_reviews = 0
+    weighted_sum = 0.0
+    weight_total = 0.0
+    for partial in partials:
+        for key, value in (partial.get("rating_distribution") or {}).items():
+            star = _star_key(key)
+            count = _number(value)
+            if star and count:
+                distribution[star] += int(round(count))
+        reviews = int(_number(partial.get("total_reviews")) or 0)
+        total_reviews += max(reviews, 0)
+        average = _number(partial.get("average_rating"))
+        if average is not None and 0 < average <= 5:
+            weight = max(reviews, 1)
+            weighted_sum += average * weight
+            weight_total += weight
+
+    return SentimentAnalysis(
+        positive_topics=_merge_topics(partials, "positive_topics"),
+        negative_topics=_merge_topics(partials, "negative_topics"),
+        rating_distribution=distribution,
+        average_rating=round(weighted_sum / weight_total, 2) if weight_total else 0.0,
+        total_reviews=total_reviews,
+    )
+
+
+def apply_known_ratings(analysis: Optional[Dict[str, Any]], known: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Replaces the model's rating estimates with the numbers read from the product page."""
+    if analysis is None or not known:
+        return analysis
+    return dict(analysis, **known)
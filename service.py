@@ -0,0 +1,309 @@
+import queue
+import asyncio
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.messages import HumanMessage, AIMessageChunk
+
+from graph import app, seed_thread, compare_app, refresh_app, COMPARE_CONCURRENCY, COMPARE_MAX_PRODUCTS
+from url_canonical import canonicalize_url
+from report_cache import get_report_cache
+from catalog import get_catalog
+from evidence_store import load_evidence
+from summarizer import schedule_summary, thread_lock
+import singleflight
+from ratelimit import priority
+
+
+# What the user sees while a node is running
+PROGRESS_LABELS = {
+    "parse_link": "Reading the product page",
+    "fallback_title_extractor": "Guessing the product from the link",
+    "researcher_amazon": "Researching Amazon reviews",
+    "researcher_reddit": "Researching Reddit discussions",
+    "researcher_web": "Researching expert reviews",
+    "dedupe_evidence": "Removing duplicate evidence",
+    "pack_evidence": "Selecting the most relevant evidence",
+    "harvest_reviews": "Analyzing sentiment",
+    "generate_report": "Writing the report",
+}
+
+
+def initial_state(url: str) -> Dict[str, Any]:
+    """Returns the input state for a new research run."""
+    return {
+        "product_link": url,
+        "research_evidence": [],
+        "messages": [],
+        "summary": ""
+    }
+
+
+def _follower_result(result: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    """Seeds the follower's own chat thread with the report of the run it waited for."""
+    if result.get("final_report"):
+        seed_thread(config, result)
+    return dict(result, coalesced=True)
+
+
+def research_product(url: str, config: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+    """Runs the research graph for the url, or serves a fresh cached report for the same product.
+
+    The result always has final_report and reviews_analysis, plus cached=True when it came from the cache.
+    On a cache hit the chat thread in config is seeded with the report so follow-up questions still work.
+    Concurrent calls for the same product share one run, the callers that waited for it get coalesced=True
+    and their own thread seeded the same way.
+    """
+    product = canonicalize_url(url)
+    cache = get_report_cache()
+
+    if use_cache:
+        cached = cache.get(product.key)
+        if cached:
+            seed_thread(config, cached)
+            return dict(cached, cached=True)
+
+    # the same product may be researched for someone else right now, we wait for that run instead of starting another
+    flight, leader = singleflight.join(product.key)
+    if not leader:
+        return _follower_result(flight.result(), config)
+
+    with singleflight.leading(product.key, flight):
+        result = app.invoke(initial_state(url), config=config)
+        if result.get("final_report"):
+            cache.put(product.key, url, result)
+        result = dict(result, cached=False)
+        flight.publish({"type": "done", "result": result})
+    return result
+
+
+async def aresearch_product(url: str, config: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+    """Async version of research_product, the researchers share the event loop (see graph.py)."""
+    product = canonicalize_url(url)
+    cache = get_report_cache()
+
+    if use_cache:
+        cached = cache.get(product.key)
+        if cached:
+            seed_thread(config, cached)
+            return dict(cached, cached=True)
+
+    flight, leader = singleflight.join(product.key)
+    if not leader:
+        return _follower_result(await asyncio.to_thread(flight.result), config)
+
+    with singleflight.leading(product.key, flight):
+        result = await app.ainvoke(initial_state(url), config=config)
+        if result.get("final_report"):
+            cache.put(product.key, url, result)
+        result = dict(result, cached=False)
+        flight.publish({"type": "done", "result": result})
+    return result
+
+
+def comparison_links(urls: List[str]) -> List[str]:
+    """Drops links to the same product and checks the comparison has 2 to COMPARE_MAX_PRODUCTS products."""
+    links = {}
+    for url in urls:
+        url = url.strip()
+        if url:
+            links.setdefault(canonicalize_url(url).key, url)
+    if not 2 <= len(links) <= COMPARE_MAX_PRODUCTS:
+        raise ValueError(f"A comparison needs 2 to {COMPARE_MAX_PRODUCTS} different products, got {len(links)}")
+    return list(links.values())
+
+
+def compare_products(urls: List[str], config: Dict[str, Any]) -> Dict[str, Any]:
+    """Researches the products in parallel and writes one comparison report.
+
+    The chat thread in config is seeded with the comparison, so follow-up questions work like after a single report.
+    """
+    links = comparison_links(urls)
+    result = compare_app.invoke({"product_links": links, "products": []}, config=dict(config, max_concurrency=COMPARE_CONCURRENCY))
+    if result.get("final_report"):
+        seed_thread(config, result)
+    return result
+
+
+async def acompare_products(urls: List[str], config: Dict[str, Any]) -> Dict[str, Any]:
+    """Async version of compare_products."""
+    links = comparison_links(urls)
+    result = await compare_app.ainvoke({"product_links": links, "products": []}, config=dict(config, max_concurrency=COMPARE_CONCURRENCY))
+    if result.get("final_report"):
+        seed_thread(config, result)
+    return result
+
+
+def _refresh_state(url: str, previous: Dict[str, Any]) -> Dict[str, Any]:
+    """Input of refresh_app: the stored run, and the date its searches should start from."""
+    return {
+        "product_link": url,
+        "product_query": previous["product_query"],
+        # the page is not fetched again, the ratings we read from it last time still beat estimates
+        "product_data": get_catalog().product_data(canonicalize_url(url), max_age=float("inf")),
+        "research_evidence": [],
+        "unique_evidence": previous["unique_evidence"],
+        "reviews_analysis": previous["reviews_analysis"],
+        "final_report": previous["final_report"],
+        "search_since": datetime.fromtimestamp(previous["created_at"], timezone.utc).date().isoformat(),
+        "messages": [],
+        "summary": "",
+    }
+
+
+def _refresh_changes(previous: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    """What the refresh found and, if the report was regenerated, how the rating and topics moved."""
+    changes = dict(result["refresh"], regenerated=result["refresh"]["material"])
+    if changes["regenerated"]:
+        before = previous.get("reviews_analysis") or {}
+        after = result.get("reviews_analysis") or {}
+        changes["average_rating"] = {"before": before.get("average_rating"), "after": after.get("average_rating")}
+        for key in ("positive_topics", "negative_topics"):
+            old, new = set(before.get(key) or []), set(after.get(key) or [])
+            changes[key] = {"added": sorted(new - old), "removed": sorted(old - new)}
+    return changes
+
+
+def _finish_refresh(url: str, key: str, previous: Dict[str, Any], result: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    changes = _refresh_changes(previous, result)
+    # only a regenerated report moves the date, so small updates add up until they are material
+    if changes["regenerated"] and result.get("final_report"):
+        get_report_cache().put(key, url, result)
+    seed_thread(config, result)
+    return dict(result, cached=False, changes=changes)
+
+
+def _refreshable_report(key: str) -> Optional[Dict[str, Any]]:
+    """The stored report of the product if a refresh can build on it, None if it needs a full research.
+
+    A refresh merges new results into the evidence of the stored report, so all of that evidence has to
+    still be in the evidence store. With part of it gone the merged set would be smaller than what the
+    stored report was written from.
+    """
+    previous = get_report_cache().get(key, max_age=float("inf"))
+    if not previous or not previous["unique_evidence"]:
+        return None
+    refs = list(dict.fromkeys(previous["unique_evidence"]))
+    loaded = len(load_evidence(refs))
+    if loaded < len(refs):
+        print(f"Refresh: {len(refs) - loaded} of {len(refs)} stored evidence items are gone, researching in full")
+        return None
+    return previous
+
+
+def refresh_product(url: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Brings the stored report of the product up to date instead of researching it from scratch.
+
+    Only results published since the last report are searched, merged into the stored evidence, and the
+    analysis and report are regenerated only when that new evidence is material. The result has a
+    "changes" summary. Products without stored evidence are researched in full.
+    """
+    product = canonicalize_url(url)
+    previous = _refreshable_report(product.key)
+    if previous is None:
+        return dict(research_product(url, config, use_cache=False), changes={"full_research": True})
+
+    result = refresh_app.invoke(_refresh_state(url, previous), config=config)
+    return _finish_refresh(url, product.key, previous, result, config)
+
+
+async def arefresh_product(url: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Async version of refresh_product."""
+    product = canonicalize_url(url)
+    previous = _refreshable_report(product.key)
+    if previous is None:
+        return dict(await aresearch_product(url, config, use_cache=False), changes={"full_research": True})
+
+    result = await refresh_app.ainvoke(_refresh_state(url, previous), config=config)
+    return _finish_refresh(url, product.key, previous, result, config)
+
+
+def stream_research(url: str, config: Dict[str, Any], use_cache: bool = True) -> Iterator[Dict[str, Any]]:
+    """Same as research_product but yields events while the graph runs.
+
+    Events are dicts with a "type":
+      progress - a node finished, has "node" and "label" (the label of the step that starts next is up to the caller)
+      token    - a piece of the report as generate_report writes it, has "text"
+      done     - the run finished, has "result" (same shape as research_product's return value)
+    """
+    product = canonicalize_url(url)
+    cache = get_report_cache()
+
+    if use_cache:
+        cached = cache.get(product.key)
+        if cached:
+            seed_thread(config, cached)
+            yield {"type": "done", "result": dict(cached, cached=True)}
+            return
+
+    # followers of a run already in flight get its events too, from the start
+    flight, leader = singleflight.join(product.key)
+    if not leader:
+        for event in flight.follow():
+            if event["type"] == "done":
+                event = {"type": "done", "result": _follower_result(event["result"], config)}
+            yield event
+        return
+
+    with singleflight.leading(product.key, flight):
+        # subgraphs=True so we also hear about the three researchers inside research_subgraph
+        for namespace, mode, chunk in app.stream(
+            initial_state(url), config=config, stream_mode=["updates", "messages"], subgraphs=True
+        ):
+            if mode == "messages":
+                message, metadata = chunk
+                # only the streamed chunks, the finished report is also written to messages as a whole AIMessage
+                if metadata.get("langgraph_node") == "generate_report" and isinstance(message, AIMessageChunk) and message.content:
+                    event = {"type": "token", "text": message.content}
+                    flight.publish(event)
+                    yield event
+            else:
+                for node in chunk:
+                    if node in PROGRESS_LABELS:
+                        event = {"type": "progress", "node": node, "label": PROGRESS_LABELS[node]}
+                        flight.publish(event)
+                        yield event
+
+        result = app.get_state(config).values
+        if result.get("final_report"):
+            cache.put(product.key, url, result)
+        event = {"type": "done", "result": dict(result, cached=False)}
+        flight.publish(event)
+    yield event
+
+
+_TURN_DONE = object()
+
+
+def stream_chat(message: str, config: Dict[str, Any]) -> Iterator[str]:
+    """Sends a follow-up question to the chat thread and yields the answer as it is generated.
+
+    Once the answer is complete the conversation is summarized in the background if it got too long.
+    """
+    # The turn runs in its own thread, so neither the thread lock nor the priority is held across
+    # our yields: a caller that stops reading does not block the thread, the turn still completes.
+    chunks: "queue.Queue" = queue.Queue()
+
+    def turn():
+        try:
+            # a user is waiting for the answer, its LLM and search calls go ahead of research runs
+            with thread_lock(config), priority("interactive"):
+                for chunk, metadata in app.stream(
+                    {"messages": [HumanMessage(content=message)]}, config=config, stream_mode="messages"
+                ):
+                    if metadata.get("langgraph_node") == "chat_node" and isinstance(chunk, AIMessageChunk) and chunk.content:
+                        chunks.put(chunk.content)
+            schedule_summary(config)
+            chunks.put(_TURN_DONE)
+        except BaseException as e:
+            chunks.put(e)
+
+    threading.Thread(target=turn, name="chat-turn", daemon=True).start()
+    while True:
+        item = chunks.get()
+        if item is _TURN_DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
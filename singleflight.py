@@ -0,0 +1,95 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from metrics import registry
+
+
+class Flight:
+    """One research run that other callers for the same product attach to.
+
+    The leader publishes the events of the run (progress, tokens and finally "done"),
+    followers get all of them, also the ones published before they attached.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events: List[Dict[str, Any]] = []
+        self._finished = False
+        self._error: Optional[BaseException] = None
+        self.followers = 0
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self._finished = True
+            self._error = error
+            self._cond.notify_all()
+
+    def follow(self) -> Iterator[Dict[str, Any]]:
+        """Yields the events of the run until it finishes, raises the leader's error if it failed."""
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self._events) and not self._finished:
+                    self._cond.wait()
+                new = self._events[seen:]
+                seen = len(self._events)
+                finished, error = self._finished, self._error
+            yield from new
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+    def result(self) -> Dict[str, Any]:
+        """Blocks until the run is done and returns its result."""
+        for event in self.follow():
+            if event["type"] == "done":
+                return event["result"]
+        raise RuntimeError("The research run finished without a result")
+
+
+_flights: Dict[str, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def join(key: str) -> Tuple[Flight, bool]:
+    """Returns the in-flight run for the key and whether we are its leader (no run was in flight)."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            registry.inc("research_coalesced")
+            return flight, False
+        flight = _flights[key] = Flight()
+        return flight, True
+
+
+@contextmanager
+def leading(key: str, flight: Flight):
+    """Wraps the leader's run, the flight is landed when it ends so followers are never left waiting."""
+    error = None
+    try:
+        yield flight
+    except BaseException as e:
+        # a closed stream or a cancelled task also ends the run for the followers
+        error = e if isinstance(e, Exception) else RuntimeError("The research run was cancelled")
+        raise
+    finally:
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        flight.finish(error)
+
+
+def stats() -> Dict[str, float]:
+    with _flights_lock:
+        return {"runs": len(_flights), "followers": sum(f.followers for f in _flights.values())}
+
+
+registry.gauge("research_in_flight", stats)
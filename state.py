@@ -19,10 +19,34 @@ class SentimentAnalysis(TypedDict):
 class AgentState(TypedDict):
     product_link: str
     product_query: str
-    research_evidence: Annotated[List[ResearchEvidence], operator.add]
+    product_data: Optional[Dict[str, Any]]  # rating, histogram and price read from the product page (structured_data.py)
+    # Evidence is kept in the evidence store (evidence_store.py), the state only holds its refs (content hashes)
+    research_evidence: Annotated[List[str], operator.add]
+    unique_evidence: Optional[List[str]]  # research_evidence without duplicates, with provenance
+    packed_evidence_ref: Optional[str]  # ref of the token budgeted evidence block shared by harvest_reviews and generate_report
     reviews_analysis: Optional[SentimentAnalysis]
     final_report: Optional[str]  # Markdown-formatted report string
 
+    # Refresh mode (see merge_refresh)
+    search_since: Optional[str]  # only search results published since this date (YYYY-MM-DD)
+    refresh: Optional[Dict[str, Any]]  # what the refresh searches found and whether the report was regenerated
+
     # Conversation state
     messages: Annotated[List[BaseMessage], add_messages]
-    summary: str
\ No newline at end of file
+    summary: str
+    summary_watermark: Optional[str]  # id of the last message already folded into summary
+
+class ProductResearch(TypedDict):
+    product_link: str
+    product_query: Optional[str]
+    reviews_analysis: Optional[SentimentAnalysis]
+    unique_evidence: List[str]  # refs into the evidence store
+    final_report: Optional[str]  # only set when the product was served from the report cache
+    error: Optional[str]
+
+class ComparisonState(TypedDict):
+    product_links: List[str]
+    products: Annotated[List[ProductResearch], operator.add]  # filled by the parallel per-product branches
+    product_query: Optional[str]  # "A vs B vs C"
+    unique_evidence: Optional[List[str]]  # evidence refs of all products, for chat follow-ups
+    final_report: Optional[str]  # Markdown comparison report
@@ -0,0 +1,24 @@
+import os
+import sqlite3
+
+# All the local caches/stores live in one directory so they are easy to find and wipe.
+CACHE_DIR = os.environ.get("CACHE_DIR", ".cache")
+
+
+def db_path(filename: str) -> str:
+    """Returns the path of a database file inside the cache directory (and creates the directory)."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, filename)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Opens a SQLite connection that can be shared between threads (callers guard it with their own lock)."""
+    if path != ":memory:":
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL lets readers in other processes (e.g. the batch runner and the UI) keep working while we write
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
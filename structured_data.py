@@ -0,0 +1,191 @@
+import re
+import json
+from typing import Any, Dict, Iterable, List, Optional
+
+# Attribute and element texts that can carry ratings, e.g. Amazon's
+#   aria-label="67 percent of reviews have 5 stars", "4.5 out of 5", "12,345 global ratings"
+# and the "5 stars, 1,234 reviews" / "5 stars represent 67% of rating" labels of other shops.
+PERCENT_PATTERNS = [
+    re.compile(r"(?P<percent>\d{1,3})\s*(?:%|percent)\s+of\s+(?:reviews|ratings)\s+have\s+(?P<star>[1-5])\s*stars?", re.I),
+    re.compile(r"(?P<star>[1-5])\s*stars?\s+represent\s+(?P<percent>\d{1,3})\s*%", re.I),
+]
+COUNT_PATTERN = re.compile(r"^\s*([1-5])\s*stars?\W{0,3}([\d,]+)\s+(?:reviews|ratings)\s*$", re.I)
+# only whole labels, "Read 3 reviews that mention battery" must not become the total
+AVERAGE_PATTERN = re.compile(r"^(?:rated\s+)?(\d(?:\.\d+)?)\s+out\s+of\s+5(?:\s+stars?)?\.?$", re.I)
+TOTAL_PATTERN = re.compile(r"^\(?([\d,]+)\s+(?:global\s+|customer\s+)?(?:ratings|reviews)\)?$", re.I)
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        found = re.search(r"\d[\d,]*(?:\.\d+)?", value)
+        if found:
+            return float(found.group(0).replace(",", ""))
+    return None
+
+
+def _types(node: Dict[str, Any]) -> List[str]:
+    kind = node.get("@type") or []
+    return [kind] if isinstance(kind, str) else [k for k in kind if isinstance(k, str)]
+
+
+def _walk(node: Any) -> Iterable[Dict[str, Any]]:
+    """Yields every object of a JSON-LD document (lists, @graph and nested values included)."""
+    if isinstance(node, list):
+        for item in node:
+            yield from _walk(item)
+    elif isinstance(node, dict):
+        yield node
+        for value in node.values():
+            if isinstance(value, (list, dict)):
+                yield from _walk(value)
+
+
+def from_json_ld(blocks: List[str]) -> Dict[str, Any]:
+    """Reads the schema.org Product (with its AggregateRating and Offer) from the page's JSON-LD scripts."""
+    data: Dict[str, Any] = {}
+    for block in blocks:
+        try:
+            document = json.loads(block, strict=False)
+        except ValueError:
+            continue
+        for node in _walk(document):
+            if "Product" not in _types(node):
+                continue
+            if node.get("name") and "name" not in data:
+                data["name"] = " ".join(str(node["name"]).split())
+            brand = node.get("brand")
+            if isinstance(brand, dict):
+                brand = brand.get("name")
+            if isinstance(brand, str) and brand.strip() and "brand" not in data:
+                data["brand"] = brand.strip()
+            offers = node.get("offers")
+            offers = offers[0] if isinstance(offers, list) and offers else offers
+            if isinstance(offers, dict) and "price" not in data:
+                price = _number(offers.get("price") or offers.get("lowPrice"))
+                if price is not None:
+                    data["price"] = price
+                    if offers.get("priceCurrency"):
+                        data["currency"] = offers["priceCurrency"]
+            rating = node.get("aggregateRating")
+            if isinstance(rating, dict) and "average_rating" not in data:
+                value = _number(rating.get("ratingValue"))
+                best = _number(rating.get("bestRating")) or 5.0
+                count = _number(rating.get("ratingCount")) or _number(rating.get("reviewCount"))
+                if value is not None and 0 < value <= best:
+                    data["average_rating"] = round(value * 5.0 / best, 2)
+                if count:
+                    data["total_reviews"] = int(count)
+    return data
+
+
+def from_open_graph(meta: Dict[str, str]) -> Dict[str, Any]:
+    """OpenGraph/product meta tags, most shops have at least the title and the price."""
+    data: Dict[str, Any] = {}
+    if meta.get("og:title"):
+        data["name"] = " ".join(meta["og:title"].split())
+    brand = meta.get("product:brand") or meta.get("og:brand")
+    if brand:
+        data["brand"] = brand.strip()
+    price = _number(meta.get("product:price:amount") or meta.get("og:price:amount"))
+    if price is not None:
+        data["price"] = price
+        currency = meta.get("product:price:currency") or meta.get("og:price:currency")
+        if currency:
+            data["currency"] = currency
+    value = _number(meta.get("og:rating"))
+    scale = _number(meta.get("og:rating_scale")) or 5.0
+    if value is not None and 0 < value <= scale:
+        data["average_rating"] = round(value * 5.0 / scale, 2)
+    count = _number(meta.get("og:rating_count"))
+    if count:
+        data["total_reviews"] = int(count)
+    return data
+
+
+def from_rating_texts(texts: List[str]) -> Dict[str, Any]:
+    """Average, total and star histogram from the rating labels of the page (Amazon and friends)."""
+    data: Dict[str, Any] = {}
+    percentages: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+    for text in texts:
+        text = " ".join(text.split())
+        if not text:
+            continue
+        for pattern in PERCENT_PATTERNS:
+            found = pattern.search(text)
+            if found:
+                percentages.setdefault(found.group("star"), float(found.group("percent")))
+                break
+        else:
+            found = COUNT_PATTERN.search(text)
+            if found:
+                counts.setdefault(found.group(1), int(found.group(2).replace(",", "")))
+                continue
+            found = AVERAGE_PATTERN.search(text)
+            if found and "average_rating" not in data and 0 < float(found.group(1)) <= 5:
+                data["average_rating"] = float(found.group(1))
+                continue
+            found = TOTAL_PATTERN.search(text)
+            if found and "total_reviews" not in data:
+                data["total_reviews"] = int(found.group(1).replace(",", ""))
+    # a few stray labels are not a histogram, stars missing from a real one are filled in by known_ratings
+    if len(counts) >= 3:
+        data["rating_distribution"] = dict(sorted(counts.items()))
+    elif len(percentages) >= 3:
+        data["rating_percentages"] = dict(sorted(percentages.items()))
+    return data
+
+
+def histogram_rows(texts: List[str]) -> int:
+    """How many different star rows of a rating histogram the labels have."""
+    stars = set()
+    for text in texts:
+        text = " ".join(text.split())
+        for pattern in PERCENT_PATTERNS:
+            found = pattern.search(text)
+            if found:
+                stars.add(found.group("star"))
+                break
+        else:
+            found = COUNT_PATTERN.search(text)
+            if found:
+                stars.add(found.group(1))
+    return len(stars)
+
+
+def extract_product_data(json_ld: List[str], meta: Dict[str, str], rating_texts: List[str]) -> Optional[Dict[str, Any]]:
+    """Merges what the page says about the product, JSON-LD first, then the rating markup, then OpenGraph.
+
+    Returns None if the page had nothing usable. The star histogram is turned into counts when the
+    total is known, so rating_distribution has the same shape as in the sentiment analysis.
+    """
+    data: Dict[str, Any] = {}
+    sources = []
+    for source, found in (("json-ld", from_json_ld(json_ld)), ("rating-markup", from_rating_texts(rating_texts)), ("open-graph", from_open_graph(meta))):
+        new = {key: value for key, value in found.items() if key not in data}
+        if new:
+            data.update(new)
+            sources.append(source)
+    if not data:
+        return None
+    percentages = data.get("rating_percentages")
+    if percentages and data.get("total_reviews") and "rating_distribution" not in data:
+        total = data["total_reviews"]
+        data["rating_distribution"] = {star: int(round(total * percent / 100)) for star, percent in percentages.items()}
+    data["sources"] = sources
+    return data
+
+
+def known_ratings(product_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """The rating fields of the sentiment analysis that the product page gave us for real."""
+    product_data = product_data or {}
+    known = {
+        key: product_data[key]
+        for key in ("average_rating", "total_reviews", "rating_distribution")
+        if product_data.get(key)
+    }
+    if "rating_distribution" in known:
+        known["rating_distribution"] = {str(star): known["rating_distribution"].get(str(star), 0) for star in range(1, 6)}
+    return known
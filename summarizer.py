@@ -0,0 +1,100 @@
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Dict, Optional
+
+from langchain_core.messages import RemoveMessage
+
+from graph import app
+from nodes import summarize_conversation, summary_cutoff
+from metrics import instrument_node, registry
+from ratelimit import priority
+
+logger = logging.getLogger(__name__)
+
+# Conversation summaries run here, after the answer has been returned
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+_pending: Dict[str, Future] = {}
+_pending_lock = threading.Lock()
+# only threads with a turn or summary in progress have a lock, the entry goes away with its last user
+_thread_locks: "weakref.WeakValueDictionary[str, ThreadLock]" = weakref.WeakValueDictionary()
+_thread_locks_lock = threading.Lock()
+
+_summarize = instrument_node("summarize_conversation", summarize_conversation)
+
+
+class ThreadLock:
+    """threading.Lock that can be weakly referenced (the builtin one cannot)."""
+
+    __slots__ = ("_lock", "__weakref__")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+def thread_lock(config: Dict[str, Any]) -> ThreadLock:
+    """Lock held while a chat turn runs on the thread, so a summary is never written in the middle of one."""
+    thread_id = config["configurable"]["thread_id"]
+    with _thread_locks_lock:
+        lock = _thread_locks.get(thread_id)
+        if lock is None:
+            lock = _thread_locks[thread_id] = ThreadLock()
+    return lock
+
+
+def schedule_summary(config: Dict[str, Any]) -> Optional[Future]:
+    """Summarizes the thread in the background if its messages went over the token trigger.
+
+    Returns the future of the job, or None when the thread does not need a summary
+    (or one is already running for it).
+    """
+    thread_id = config["configurable"]["thread_id"]
+    if not summary_cutoff(app.get_state(config).values.get("messages", [])):
+        return None
+    with _pending_lock:
+        if thread_id in _pending:
+            return None
+        future = _executor.submit(_run, config)
+        _pending[thread_id] = future
+    future.add_done_callback(lambda _: _forget(thread_id))
+    return future
+
+
+def _forget(thread_id: str) -> None:
+    with _pending_lock:
+        _pending.pop(thread_id, None)
+
+
+def _run(config: Dict[str, Any]) -> None:
+    config = {"configurable": {"thread_id": config["configurable"]["thread_id"]}}
+    try:
+        # the LLM call happens without the lock, a new turn can start meanwhile
+        with priority("background"):
+            update = _summarize(app.get_state(config).values)
+        if not update:
+            return
+        with thread_lock(config):
+            # only remove messages still in the thread, a concurrent turn may have rewritten it
+            present = {m.id for m in app.get_state(config).values.get("messages", [])}
+            update["messages"] = [m for m in update["messages"] if isinstance(m, RemoveMessage) and m.id in present]
+            app.update_state(config, update, as_node="summarize_conversation")
+        registry.inc("summaries", status="ok")
+    except Exception:
+        logger.exception("Summarizing thread %s failed", config["configurable"]["thread_id"])
+        registry.inc("summaries", status="error")
+
+
+def wait_for_summaries(timeout: Optional[float] = None) -> None:
+    """Blocks until the running summaries are done (used by the benchmark and on shutdown)."""
+    with _pending_lock:
+        futures = list(_pending.values())
+    for future in futures:
+        future.result(timeout=timeout)
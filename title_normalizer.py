@@ -0,0 +1,155 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+from storage import connect, db_path
+
+# Below this confidence parse_link asks the LLM instead of trusting the rules
+MIN_CONFIDENCE = float(os.environ.get("TITLE_RULE_MIN_CONFIDENCE", "0.6"))
+
+# Titles of captcha / error pages, there is no product name in these
+BLOCKED_TITLES = re.compile(
+    r"^(robot check|access denied.*|page not found|404.*|403.*|sorry!?|something went wrong|are you a human\??|"
+    r"amazon\.[a-z.]+|walmart\.com|best buy|flipkart\.com|just a moment\.*|attention required.*|"
+    r"welcome to .*|sign in|log ?in|shopping cart|your cart|captcha.*|security check.*|home ?page)$",
+    re.IGNORECASE,
+)
+
+# domain keyword -> list of (pattern, replacement) substitutions, all case insensitive and applied in order
+DOMAIN_RULES: List[Tuple[str, List[Tuple[str, str]]]] = [
+    ("amazon", [
+        # "Amazon.com: Name : Electronics" -> "Name" (the category is only stripped together with the prefix)
+        (r"^amazon(\.[a-z]{2,3}){1,2}\s*:\s*(.+?)(\s+:\s+[\w&,' ]{1,40})?$", r"\2"),
+        # "Name : Amazon.in: Electronics" -> "Name"
+        (r"\s+:\s+amazon(\.[a-z]{2,3}){1,2}(\s*:.*)?$", ""),
+    ]),
+    ("bestbuy", [(r"\s*[-|]\s*best\s*buy(\s*canada)?$", "")]),
+    ("walmart", [(r"\s*[-|]\s*walmart(\.com|\.ca)?$", "")]),
+    ("flipkart", [
+        (r"\s*\|\s*flipkart(\.com)?$", ""),
+        (r"\s+online\s+at\s+(best|lowest)\s+price.*$", ""),
+        (r"^buy\s+", ""),
+    ]),
+    ("target", [(r"\s*:\s*target$", "")]),
+    ("ebay", [(r"\s*\|\s*ebay$", "")]),
+    ("newegg", [(r"\s*[-|]\s*newegg(\.com|\.ca)?$", "")]),
+    ("costco", [(r"\s*\|\s*costco$", "")]),
+    ("homedepot", [(r"\s*[-|]\s*the\s*home\s*depot$", "")]),
+]
+
+
+@dataclass
+class NormalizedTitle:
+    name: str
+    confidence: float
+    rule: str
+
+    @property
+    def confident(self) -> bool:
+        return self.confidence >= MIN_CONFIDENCE
+
+    @property
+    def blocked(self) -> bool:
+        return self.rule == "blocked"
+
+
+def _domain(url: str) -> str:
+    host = urlparse(url).netloc.lower()
+    return host.replace("www.", "").replace("-", "")
+
+
+def _looks_like_product(name: str) -> bool:
+    words = name.split()
+    return 2 <= len(words) <= 30 and 3 <= len(name) <= 200
+
+
+def normalize_title(title: str, url: str) -> NormalizedTitle:
+    """Strips retailer boilerplate from a page title and says how sure we are about the result."""
+    title = " ".join(title.split())
+    if not title or BLOCKED_TITLES.match(title):
+        return NormalizedTitle("", 0.0, "blocked")
+
+    domain = _domain(url)
+    for keyword, substitutions in DOMAIN_RULES:
+        if keyword not in domain:
+            continue
+        name = title
+        for pattern, replacement in substitutions:
+            name = re.sub(pattern, replacement, name, flags=re.IGNORECASE)
+        name = name.strip(" -|:")
+        if not _looks_like_product(name):
+            return NormalizedTitle(name, 0.3, keyword)
+        return NormalizedTitle(name, 0.9, keyword)
+
+    # Unknown shop: drop a trailing " | Shop Name" / " - Shop Name" if the shop name is part of the domain
+    parts = re.split(r"\s+[|\-–—:]\s+", title)
+    if len(parts) > 1:
+        site = re.sub(r"[^a-z0-9]", "", parts[-1].lower())
+        if site and site.split("com")[0] and site.split("com")[0] in domain.replace(".", ""):
+            name = " - ".join(parts[:-1]).strip()
+            if _looks_like_product(name):
+                return NormalizedTitle(name, 0.7, "generic")
+        return NormalizedTitle(title, 0.4, "generic")
+
+    # a title without any shop boilerplate may just as well be the shop's own ("Our Summer Collection"),
+    # so it stays below MIN_CONFIDENCE and the LLM has the last word
+    if _looks_like_product(title):
+        return NormalizedTitle(title, 0.5, "plain")
+    return NormalizedTitle(title, 0.3, "plain")
+
+
+class TitleMemo:
+    """Memo table from raw page title to product name (in memory LRU in front of SQLite)."""
+
+    def __init__(self, path: str, max_memory_entries: int = 2048):
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS title_memo (title TEXT PRIMARY KEY, product_name TEXT NOT NULL, rule TEXT)"
+        )
+        self._conn.commit()
+
+    def get(self, title: str) -> Optional[str]:
+        with self._lock:
+            if title in self._memory:
+                self._memory.move_to_end(title)
+                return self._memory[title]
+            row = self._conn.execute("SELECT product_name FROM title_memo WHERE title = ?", (title,)).fetchone()
+            if row is None:
+                return None
+            self._remember(title, row[0])
+            return row[0]
+
+    def put(self, title: str, product_name: str, rule: str = "") -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO title_memo (title, product_name, rule) VALUES (?, ?, ?)",
+                (title, product_name, rule),
+            )
+            self._conn.commit()
+            self._remember(title, product_name)
+
+    def _remember(self, title: str, product_name: str) -> None:
+        self._memory[title] = product_name
+        self._memory.move_to_end(title)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+_title_memo = None
+_title_memo_lock = threading.Lock()
+
+
+def get_title_memo() -> TitleMemo:
+    """Returns the shared title memo table."""
+    global _title_memo
+    with _title_memo_lock:
+        if _title_memo is None:
+            _title_memo = TitleMemo(os.environ.get("TITLE_MEMO_PATH") or db_path("title_memo.sqlite"))
+    return _title_memo
@@ -0,0 +1,91 @@
+import re
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+# Query parameters that only track where the click came from, they never change the product
+TRACKING_PARAMS = re.compile(
+    r"^(utm_.*|ref|ref_|tag|psc|th|smid|spm|gclid|fbclid|msclkid|mc_cid|mc_eid|_encoding|"
+    r"qid|sr|keywords|crid|sprefix|dib|dib_tag|content-id|pd_rd_.*|pf_rd_.*|linkcode|linkid|camp|creative|"
+    r"athena.*|irgwc|clickid|affiliates_ad_id|wmlspartner|sourceid|veh|lid|marketplace|srno|otracker.*|fm|iid|ppt|ppn|ssid|cmpid|intl)$",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class CanonicalProduct:
+    retailer: str
+    product_id: Optional[str]  # ASIN / SKU / item id, None if we could not find one
+    key: str                   # stable cache key, same for every link to the same item
+    url: str                   # cleaned up link to the product page
+
+
+def _host(netloc: str) -> str:
+    host = netloc.lower().split(":")[0]
+    if host.startswith("www."):
+        host = host[4:]
+    if host.startswith("m.") or host.startswith("smile.") or host.startswith("old."):
+        host = host.split(".", 1)[1]
+    return host
+
+
+def _match(pattern: str, text: str) -> Optional[str]:
+    found = re.search(pattern, text, flags=re.IGNORECASE)
+    return found.group(1) if found else None
+
+
+def canonicalize_url(url: str) -> CanonicalProduct:
+    """Maps a product link to its retailer + product id so tracking params and path variants share one key."""
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    parsed = urlparse(url)
+    host = _host(parsed.netloc)
+    path = parsed.path
+    query = dict(parse_qsl(parsed.query))
+
+    if "amazon." in host or host in ("amzn.com", "a.co"):
+        # /dp/ASIN, /gp/product/ASIN, /gp/aw/d/ASIN, /exec/obidos/ASIN/ASIN, /o/ASIN/ASIN
+        asin = _match(r"/(?:dp|gp/product|gp/aw/d|exec/obidos/asin|o/asin|product)/([A-Z0-9]{10})(?:[/?]|$)", path)
+        if asin:
+            asin = asin.upper()
+            return CanonicalProduct("amazon", asin, f"{host}:{asin}", f"https://www.{host}/dp/{asin}")
+
+    elif "bestbuy." in host:
+        sku = _match(r"/(\d{6,8})\.p$", path) or query.get("skuId")
+        if sku:
+            return CanonicalProduct("bestbuy", sku, f"{host}:{sku}", f"https://www.{host}/site/{sku}.p?skuId={sku}")
+
+    elif "walmart." in host:
+        item = _match(r"/ip/(?:[^/]+/)?(\d+)", path)
+        if item:
+            return CanonicalProduct("walmart", item, f"{host}:{item}", f"https://www.{host}/ip/{item}")
+
+    elif "flipkart." in host:
+        pid = query.get("pid") or _match(r"/p/(itm[a-z0-9]+)", path)
+        if pid:
+            return CanonicalProduct("flipkart", pid, f"{host}:{pid}", f"https://www.{host}/product/p/itme?pid={pid}")
+
+    elif "target." in host:
+        tcin = _match(r"/A-(\d+)", path)
+        if tcin:
+            return CanonicalProduct("target", tcin, f"{host}:{tcin}", f"https://www.{host}/p/A-{tcin}")
+
+    elif "ebay." in host:
+        item = _match(r"/itm/(?:[^/]+/)?(\d+)", path)
+        if item:
+            return CanonicalProduct("ebay", item, f"{host}:{item}", f"https://www.{host}/itm/{item}")
+
+    elif "newegg." in host:
+        item = query.get("Item") or _match(r"/p/([A-Z0-9-]+)", path)
+        if item:
+            item = item.upper()
+            return CanonicalProduct("newegg", item, f"{host}:{item}", f"https://www.{host}/p/{item}")
+
+    # Any other shop: drop the tracking params, fragment and trailing slash and use what is left as the key
+    kept = sorted((k, v) for k, v in parse_qsl(parsed.query) if not TRACKING_PARAMS.match(k))
+    clean_path = path.rstrip("/") or "/"
+    clean_query = urlencode(kept)
+    key = f"{host}{clean_path}" + (f"?{clean_query}" if clean_query else "")
+    clean_url = f"{parsed.scheme or 'https'}://{parsed.netloc.lower()}{clean_path}" + (f"?{clean_query}" if clean_query else "")
+    return CanonicalProduct(host.split(".")[0], None, key, clean_url)
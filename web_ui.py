@@ -1,6 +1,8 @@
 import streamlit as st
 import sys
 import os
+import time
+import uuid
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,6 +12,8 @@ load_dotenv()
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from graph import app
+from service import stream_chat
+from jobs import get_job_manager, QueueFull
 
 # Page configuration
 st.set_page_config(
@@ -179,6 +183,11 @@ if "report" not in st.session_state:
     st.session_state.report = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "session_id" not in st.session_state:
+    # every browser session gets its own chat threads
+    st.session_state.session_id = uuid.uuid4().hex
+if "job_id" not in st.session_state:
+    st.session_state.job_id = st.query_params.get("job")
 
 # Input section
 url = st.text_input(
@@ -201,43 +210,63 @@ if st.button("Generate Report", type="primary"):
             st.error("TAVILY_API_KEY not found. Please set it in your .env file.")
             st.stop()
         
-        # Show progress
-        with st.spinner("Analyzing product... This may take 15-30 seconds"):
-            try:
-                # Initialize state
-                initial_state = {
-                    "product_link": url,
-                    "research_evidence": [],
-                    "messages": [],
-                    "summary": ""
-                }
-                
-                # Run the agent
-                # Use a thread_id for persistence
-                thread_id = "web_session_1"
-                config = {"configurable": {"thread_id": thread_id}}
-                
-                result = app.invoke(initial_state, config=config)
-                
-                # Get report
-                report = result.get("final_report")
-                
-                if report:
-                    # Store report in session state to persist across reruns
-                    st.session_state.report = report
-                    st.session_state.thread_config = config
-                    st.session_state.messages = [] # Reset chat on new report
-                    st.rerun()
-                else:
-                    st.error("No report generated. Please try again.")
-                    
-            except Exception as e:
-                st.error(f"Error: {str(e)}")
-                st.error("Please check your API keys and try again.")
+        # The research runs as a background job, so it survives reruns and refreshes of this page
+        # Use a thread_id for persistence, a new thread per report so evidence from an older report never mixes in
+        thread_id = f"web-{st.session_state.session_id}-{uuid.uuid4().hex[:8]}"
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            st.session_state.job_id = get_job_manager().submit(url, config)
+            # in the URL too, a refreshed page (a new session) picks the job up again
+            st.query_params["job"] = st.session_state.job_id
+        except QueueFull as e:
+            st.warning(str(e))
+
+# Progress of the running job, the script polls it by rerunning until the job is finished
+if st.session_state.get("job_id"):
+    jobs = get_job_manager()
+    job = jobs.get(st.session_state.job_id)
+    if job is None:
+        # the server restarted or the job expired
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+    elif job.status == "queued":
+        st.info(f"Waiting for a free slot, position {jobs.queue_position(job.id)} in the queue...")
+        time.sleep(1)
+        st.rerun()
+    elif job.status == "running":
+        # Show progress: every finished step is listed and the report is rendered while it is being written
+        status = st.status("Analyzing product...", expanded=True)
+        for label in job.progress:
+            status.write(f"✓ {label}")
+        if job.report:
+            st.markdown(job.report)
+        time.sleep(0.5)
+        st.rerun()
+    else:
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+        # Repeat requests for the same product (even with different tracking params) come from the report cache
+        result = job.result or {}
+        report = result.get("final_report")
+        if job.status == "done" and report:
+            # Store report in session state to persist across reruns
+            st.session_state.report = report
+            st.session_state.report_cached = result.get("cached", False)
+            st.session_state.thread_config = job.config
+            st.session_state.messages = [] # Reset chat on new report
+            st.session_state.summarized = False
+            st.rerun()
+        elif job.status == "done":
+            st.error("No report generated. Please try again.")
+        else:
+            st.error(f"Error: {job.error}")
+            st.error("Please check your API keys and try again.")
 
 # Display Report if available
 if st.session_state.get("report"):
     st.markdown("---")
+    if st.session_state.get("report_cached"):
+        st.caption("Served from a recent report for this product")
     st.markdown(f'<div class="report-container">{st.session_state.report}</div>', unsafe_allow_html=True)
 
     
@@ -253,29 +282,19 @@ if st.session_state.get("report"):
         with st.chat_message("user"):
             st.markdown(prompt)
             
-        # Get response from agent
+        # Get response from agent, the answer is shown as it streams in
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                from langchain_core.messages import HumanMessage
-                
-                # Invoke graph with new message
-                response = app.invoke(
-                    {"messages": [HumanMessage(content=prompt)]}, 
-                    config=st.session_state.thread_config
-                )
+            ai_response = st.write_stream(stream_chat(prompt, st.session_state.thread_config))
+            
+            if ai_response:
+                # Add AI message to UI
+                st.session_state.messages.append({"role": "assistant", "content": ai_response})
                 
-                # Get latest AI response
-                if response.get("messages"):
-                    last_msg = response["messages"][-1]
-                    ai_response = last_msg.content
-                    st.markdown(ai_response)
-                    
-                    # Add AI message to UI
-                    st.session_state.messages.append({"role": "assistant", "content": ai_response})
-                    
-                    # Check for summary
-                    if response.get("summary") and len(response["messages"]) <= 2:
-                        st.caption("Conversation summarized to save memory")
+                # Older messages are summarized in the background once the chat gets long
+                response = app.get_state(st.session_state.thread_config).values
+                if response.get("summary") and not st.session_state.get("summarized"):
+                    st.session_state.summarized = True
+                    st.caption("Older messages summarized to save memory")
     
     # Reset Button
     if st.session_state.get("report"):